@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: BSD-3-Clause
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+
+import trawler
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'arm')
+
+class SearchHandler(BaseHTTPRequestHandler):
+	"""
+	Plays back the recorded search responses, picked by the first result asked for.
+	"""
+
+	requests = []
+
+	def do_POST(self):
+		body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+		self.requests.append((self.headers.get('Authorization'), body))
+
+		if self.headers.get('Authorization') != 'Bearer test-token':
+			self.send_response(401)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+
+		with open(os.path.join(FIXTURES, f'search_{body["firstResult"]}.json'), 'rb') as f:
+			content = f.read()
+
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def log_message(self, *args):
+		pass
+
+class ArmHTTPCollectTest(unittest.TestCase):
+	def setUp(self):
+		SearchHandler.requests = []
+		self.server = HTTPServer(('127.0.0.1', 0), SearchHandler)
+		threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+		self.tmp = tempfile.TemporaryDirectory()
+		self.cache = os.path.join(self.tmp.name, 'trawler.db')
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.tmp.cleanup()
+
+	def run_trawler(self, *arm_args):
+		argv = [
+			'trawler', '-c', self.cache, '-o', os.path.join(self.tmp.name, 'out'),
+			'-p', os.path.join(self.tmp.name, 'profile'), '-d', '0', '-r', '1', '-E', '-D',
+			'arm', '--arm-collect-mode', 'http', '--arm-page-size', '2',
+			'--arm-search-url', f'http://127.0.0.1:{self.server.server_port}/rest/search/v2',
+		] + list(arm_args)
+
+		with mock.patch.object(sys, 'argv', argv):
+			return trawler.main()
+
+	def datasheets(self):
+		db = sqlite3.connect(self.cache)
+		try:
+			sheets = dict(db.execute('SELECT title, src FROM datasheets'))
+			tags = {}
+			for title, name in db.execute(
+				'SELECT d.title, t.name FROM tag_links l INNER JOIN datasheets d ON d.id = l.datasheet_id '
+				'INNER JOIN datasheet_tags t ON t.id = l.tag_id'
+			):
+				tags.setdefault(title, set()).add(name)
+			return (sheets, tags)
+		finally:
+			db.close()
+
+	def test_collects_every_page(self):
+		self.assertEqual(self.run_trawler('--arm-search-token', 'test-token'), 0)
+
+		self.assertEqual([ body['firstResult'] for _, body in SearchHandler.requests ], [ 0, 2 ])
+		self.assertTrue(all(auth == 'Bearer test-token' for auth, _ in SearchHandler.requests))
+		self.assertEqual(SearchHandler.requests[0][1]['numberOfResults'], 2)
+		self.assertIn('"Technical Reference Manual"', SearchHandler.requests[0][1]['aq'])
+
+		sheets, tags = self.datasheets()
+		# The result without a title is passed over
+		self.assertEqual(sheets, {
+			'Arm Cortex-A53 MPCore Processor Technical Reference Manual': 'https://developer.arm.com/documentation/ddi0500/j/',
+			'Arm Architecture Reference Manual for A-profile architecture': 'https://developer.arm.com/documentation/ddi0487/ka/',
+			'Arm CoreLink GIC-600 Generic Interrupt Controller Technical Reference Manual': 'https://developer.arm.com/documentation/100336/latest/',
+		})
+		self.assertEqual(
+			tags['Arm Cortex-A53 MPCore Processor Technical Reference Manual'],
+			{ 'Technical Reference Manual', 'Cortex-A', 'Cortex-A53' }
+		)
+		self.assertEqual(
+			tags['Arm Architecture Reference Manual for A-profile architecture'],
+			{ 'Architecture Document', 'Architectures', 'A-profile' }
+		)
+
+	def test_rejected_token_collects_nothing(self):
+		self.assertEqual(self.run_trawler('--arm-search-token', 'wrong'), 0)
+
+		self.assertEqual(len(SearchHandler.requests), 1)
+		self.assertEqual(self.datasheets(), ({}, {}))
+
+	def test_no_token_falls_back_to_the_browser(self):
+		with mock.patch('trawler.adapters.arm.collect_stage') as collect_stage, mock.patch('trawler.adapters.arm.Pipeline'):
+			self.assertEqual(self.run_trawler(), 0)
+
+		self.assertEqual(SearchHandler.requests, [])
+		collect_stage.assert_called_once()
+
+if __name__ == '__main__':
+	unittest.main()
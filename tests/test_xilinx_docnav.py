@@ -0,0 +1,107 @@
+# SPDX-License-Identifier: BSD-3-Clause
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+
+import trawler
+import trawler.adapters.xilinx
+
+INDEX = '''<?xml version="1.0" encoding="UTF-8"?>
+<documentation>
+<catalog label="Zynq" productName="Zynq" collection="docs">
+<group label="User Guides">
+<document><title>Zynq TRM</title><webLocation>{root}/{pdf}</webLocation><docID>UG585</docID><docType>UG</docType><functionTags>trm</functionTags></document>
+</group>
+</catalog>
+</documentation>
+'''
+
+class DocNavHandler(BaseHTTPRequestHandler):
+	"""
+	Serves the DocNav index with the document at `pdf`, and the document itself.
+	"""
+
+	pdf = 'ug585-v1.pdf'
+	requests = []
+
+	def do_GET(self):
+		self.requests.append(self.path)
+
+		if self.path == '/xdocs.xml':
+			content = INDEX.format(root = f'http://127.0.0.1:{self.server.server_port}', pdf = self.pdf).encode('utf-8')
+		else:
+			content = f'%PDF {self.path}'.encode('utf-8')
+
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def log_message(self, *args):
+		pass
+
+class DocNavSyncTest(unittest.TestCase):
+	def setUp(self):
+		DocNavHandler.pdf = 'ug585-v1.pdf'
+		DocNavHandler.requests = []
+		self.server = HTTPServer(('127.0.0.1', 0), DocNavHandler)
+		threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+		self.tmp = tempfile.TemporaryDirectory()
+		self.cache = os.path.join(self.tmp.name, 'trawler.db')
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.tmp.cleanup()
+
+	def run_trawler(self):
+		argv = [
+			'trawler', '-c', self.cache, '-o', os.path.join(self.tmp.name, 'out'),
+			'-p', os.path.join(self.tmp.name, 'profile'), '-d', '0', '-r', '1', 'xilinx',
+		]
+
+		index = f'http://127.0.0.1:{self.server.server_port}/xdocs.xml'
+		with mock.patch.object(sys, 'argv', argv), mock.patch.object(trawler.adapters.xilinx, 'XILINX_DOCS_INDEX', index):
+			return trawler.main()
+
+	def datasheet(self):
+		db = sqlite3.connect(self.cache)
+		try:
+			return db.execute('SELECT url, filename, dl_location, downloaded FROM datasheets WHERE title = ?', ('Zynq TRM',)).fetchone()
+		finally:
+			db.close()
+
+	def test_moved_document_is_downloaded_again(self):
+		self.assertEqual(self.run_trawler(), 0)
+		url, filename, dl_location, downloaded = self.datasheet()
+		self.assertTrue(url.endswith('/ug585-v1.pdf'))
+		self.assertEqual(filename, 'ug585-v1.pdf')
+		self.assertTrue(downloaded)
+
+		DocNavHandler.pdf = 'ug585-v2.pdf'
+		self.assertEqual(self.run_trawler(), 0)
+		url, filename, dl_location, downloaded = self.datasheet()
+		self.assertTrue(url.endswith('/ug585-v2.pdf'))
+		self.assertEqual(filename, 'ug585-v2.pdf')
+		self.assertTrue(downloaded)
+		self.assertIn('/ug585-v2.pdf', DocNavHandler.requests)
+
+		with open(dl_location, 'rb') as f:
+			self.assertEqual(f.read(), b'%PDF /ug585-v2.pdf')
+		self.assertEqual(os.path.basename(os.path.dirname(dl_location)), 'User Guides')
+
+	def test_unchanged_document_is_not_downloaded_again(self):
+		self.assertEqual(self.run_trawler(), 0)
+		self.assertEqual(self.run_trawler(), 0)
+
+		self.assertEqual(DocNavHandler.requests.count('/ug585-v1.pdf'), 1)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -2,6 +2,8 @@
 
 __all__ = ('main')
 
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
 def _init_directories():
 	from . import config
 
@@ -36,47 +38,148 @@ def _populate_webdriver_opts(args):
 
 	return opts
 
+def _adapter_manifest(mod_path):
+	"""
+	Read the name, description and flags an adapter declares at the top level
+	of its module without importing it, returns None if it isn't an adapter.
+	"""
+	import ast
+
+	with open(mod_path, 'r') as f:
+		tree = ast.parse(f.read(), filename = mod_path)
+
+	decls = {}
+	for node in tree.body:
+		if isinstance(node, ast.Assign):
+			for target in node.targets:
+				if isinstance(target, ast.Name):
+					decls[target.id] = node.value
+
+	if 'DONT_LOAD' in decls or 'ADAPTER_NAME' not in decls:
+		return None
+
+	try:
+		return {
+			'name': ast.literal_eval(decls['ADAPTER_NAME']),
+			'description': ast.literal_eval(decls['ADAPTER_DESC']) if 'ADAPTER_DESC' in decls else '',
+			'is_meta': 'META_ADAPTER' in decls,
+			'uses_webdriver': ast.literal_eval(decls['USES_WEBDRIVER']) if 'USES_WEBDRIVER' in decls else True,
+		}
+	except ValueError:
+		# Not something we can work out without running it, so do it the slow way
+		return False
+
 def _collect_adapters():
+	import os
 	import pkgutil
 
-	from . import db
+	from . import config
 	from . import adapters
+	from .common import wrn
 
 	adpts = []
-	# Load the built-in internal adapters
-	for _, name, is_pkg in pkgutil.iter_modules(path = getattr(adapters, '__path__')):
-		if not is_pkg:
-			__import__(f'{getattr(adapters, "__name__")}.{name}')
-			if not hasattr(getattr(adapters, name), 'DONT_LOAD'):
-				adpts.append({
-					'name': getattr(adapters, name).ADAPTER_NAME,
-					'description': getattr(adapters, name).ADAPTER_DESC,
-					'parser_init': getattr(adapters, name).parser_init,
-					'main': getattr(adapters, name).adapter_main,
-					'is_meta': hasattr(getattr(adapters, name), 'META_ADAPTER'),
-				})
-	# Load the adapters from the share
-	# TODO: this
+	search = (
+		# The built-in internal adapters
+		(getattr(adapters, '__path__')[0], 'built-in'),
+		# The adapters from the share
+		(config.TRAWLER_USER_ADAPTERS, 'user'),
+	)
+
+	for mod_dir, origin in search:
+		if not os.path.isdir(mod_dir):
+			continue
+
+		for _, name, is_pkg in pkgutil.iter_modules(path = [ mod_dir ]):
+			if is_pkg:
+				continue
+
+			mod_path = os.path.join(mod_dir, f'{name}.py')
+			try:
+				manifest = _adapter_manifest(mod_path)
+			except (OSError, SyntaxError) as e:
+				wrn(f'Unable to read {origin} adapter {mod_path}: {e}')
+				continue
+
+			adpt = {
+				'module': name,
+				'path': mod_path,
+				'origin': origin,
+			}
+
+			if manifest is None:
+				continue
+			elif manifest is False:
+				mod = _load_adapter(adpt)
+				if hasattr(mod, 'DONT_LOAD'):
+					continue
+				manifest = {
+					'name': mod.ADAPTER_NAME,
+					'description': mod.ADAPTER_DESC,
+					'is_meta': hasattr(mod, 'META_ADAPTER'),
+					'uses_webdriver': getattr(mod, 'USES_WEBDRIVER', True),
+				}
+
+			adpt.update(manifest)
+			if adpt['name'] in map(lambda a: a['name'], adpts):
+				wrn(f'Ignoring {origin} adapter {mod_path}, there is already an adapter named {adpt["name"]}')
+				continue
+
+			adpts.append(adpt)
 
 	return adpts
 
+def _load_adapter(adpt):
+	"""
+	Import the module behind an adapter, and fill in the bits of it we need.
+	"""
+	import sys
+	import types
+	import importlib
+	import importlib.util
 
-def main():
 	from . import config
-	from . import db
-	from .common import log, err, wrn, inf, dbg
-
-	import os
-	from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-
-	from orator import DatabaseManager, Model
-	from selenium import webdriver
-
-	_init_directories()
+	from . import adapters
 
-	ADAPTERS = _collect_adapters()
+	if adpt['origin'] == 'built-in':
+		mod_name = f'{getattr(adapters, "__name__")}.{adpt["module"]}'
+	else:
+		# User adapters get a package of their own, so one named like a built-in can't be mistaken for
+		# it, but at the same depth so they can be written the same way as the built-in ones
+		pkg_name = f'{__name__}.user_adapters'
+		if pkg_name not in sys.modules:
+			pkg = types.ModuleType(pkg_name)
+			pkg.__path__ = [ config.TRAWLER_USER_ADAPTERS ]
+			sys.modules[pkg_name] = pkg
+		mod_name = f'{pkg_name}.{adpt["module"]}'
+
+	if adpt['origin'] == 'built-in':
+		mod = importlib.import_module(mod_name)
+	elif mod_name in sys.modules:
+		mod = sys.modules[mod_name]
+	else:
+		spec = importlib.util.spec_from_file_location(mod_name, adpt['path'])
+		mod = importlib.util.module_from_spec(spec)
+		sys.modules[mod_name] = mod
+		spec.loader.exec_module(mod)
+
+	adpt['parser_init'] = mod.parser_init
+	adpt['main'] = mod.adapter_main
+	adpt['rate_limits'] = getattr(mod, 'RATE_LIMITS', {})
+	return mod
+
+class _PeekParser(ArgumentParser):
+	# Used to find out which adapter was asked for, without complaining about anything else
+	def error(self, message):
+		raise ValueError(message)
+
+def _build_parser(ADAPTERS, selected = None, parser_class = ArgumentParser):
+	from . import config
+	from .common import parse_rate
 
-	parser = ArgumentParser(formatter_class = ArgumentDefaultsHelpFormatter, description = f'Trawler datasheet scraper')
+	parser = parser_class(
+		formatter_class = ArgumentDefaultsHelpFormatter, description = f'Trawler datasheet scraper',
+		add_help = parser_class is not _PeekParser
+	)
 
 	scraper_options = parser.add_argument_group('Global scraper options')
 
@@ -105,7 +208,58 @@ def main():
 		'--delay', '-d',
 		type = int,
 		default = config.DEFAULT_DOWNLOAD_DELAY,
-		help = 'Download delay in seconds'
+		help = 'Default delay in seconds between requests to the same host'
+	)
+
+	scraper_options.add_argument(
+		'--backoff',
+		type = float,
+		default = config.DEFAULT_BACKOFF,
+		help = 'Base delay in seconds for the exponential backoff between retries'
+	)
+
+	scraper_options.add_argument(
+		'--rate',
+		type = parse_rate,
+		default = [],
+		action = 'append',
+		help = 'Rate limit for a host, as host=requests_per_second[:burst], may be given more than once'
+	)
+
+	scraper_options.add_argument(
+		'--jobs', '-j',
+		type = int,
+		default = config.DEFAULT_DOWNLOAD_JOBS,
+		help = 'Number of concurrent downloads'
+	)
+
+	scraper_options.add_argument(
+		'--max-per-host',
+		type = int,
+		default = config.DEFAULT_MAX_PER_HOST,
+		help = 'Maximum number of concurrent downloads from any one host'
+	)
+
+	scraper_options.add_argument(
+		'--pool-size',
+		type = int,
+		default = config.DEFAULT_POOL_SIZE,
+		help = 'Number of pooled HTTP connections to keep per host'
+	)
+
+	scraper_options.add_argument(
+		'--no-keep-alive',
+		dest = 'keep_alive',
+		default = True,
+		action = 'store_false',
+		help = 'Don\'t reuse HTTP connections between requests'
+	)
+
+	scraper_options.add_argument(
+		'--queue-size',
+		type = int,
+		default = config.DEFAULT_PIPELINE_QUEUE,
+		help = 'How many datasheets can be waiting between stages before the earlier stage holds off'
 	)
 
 	scraper_options.add_argument(
@@ -115,6 +269,13 @@ def main():
 		help = 'Cache database'
 	)
 
+	scraper_options.add_argument(
+		'--db-busy-timeout',
+		type = float,
+		default = config.DEFAULT_DB_BUSY_TIMEOUT,
+		help = 'How long in seconds to wait on a locked database before giving up'
+	)
+
 	scraper_options.add_argument(
 		'--skip-collect', '-C',
 		default = False,
@@ -136,6 +297,34 @@ def main():
 		help = 'Skip the datasheet extraction stage'
 	)
 
+	scraper_options.add_argument(
+		'--force', '-F',
+		default = False,
+		action = 'store_true',
+		help = 'Re-download datasheets even if they are already on disk'
+	)
+
+	scraper_options.add_argument(
+		'--retry-failed',
+		default = False,
+		action = 'store_true',
+		help = 'Try downloading datasheets whose links were previously found to be dead'
+	)
+
+	scraper_options.add_argument(
+		'--refresh-older-than',
+		type = float,
+		default = config.DEFAULT_REFRESH_AGE,
+		help = 'Re-check datasheets on disk that were last fetched more than this many days ago'
+	)
+
+	scraper_options.add_argument(
+		'--blob-store',
+		type = str,
+		default = config.DEFAULT_BLOB_STORE,
+		help = 'Keep one copy of each unique datasheet in this directory and link it into place'
+	)
+
 	scraper_options.add_argument(
 		'--skip-archives',
 		default = False,
@@ -202,6 +391,13 @@ def main():
 		help = 'Specify the width of the headless window'
 	)
 
+	wd_options.add_argument(
+		'--browsers', '-B',
+		type = int,
+		default = config.DEFAULT_WD_POOL_SIZE,
+		help = 'Number of WebDriver instances to run in parallel, each with its own copy of the profile'
+	)
+
 	# Maybe one day
 	# wd_options.add_argument(
 	# 	'--proxy', '-P',
@@ -215,17 +411,47 @@ def main():
 			required = True
 		)
 
-	# Add the adapter settings
+	# Add the adapter settings, only the one being run needs its options
 	for adpt in ADAPTERS:
 		ap = adapter_parser.add_parser(
 				adpt['name'],
-				help = adpt['description']
+				help = adpt['description'],
+				add_help = parser_class is not _PeekParser
 			)
-		adpt['parser_init'](ap)
+		if adpt is selected:
+			adpt['parser_init'](ap)
+
+	return parser
+
+def main():
+	from . import config
+	from .common import log, err, wrn, inf, dbg
+
+	import os
+
+	_init_directories()
+
+	ADAPTERS = _collect_adapters()
+
+	# Work out which adapter we're running first, so we only have to load that one
+	try:
+		peek, _ = _build_parser(ADAPTERS, parser_class = _PeekParser).parse_known_args()
+		selected = next(filter(lambda a: a['name'] == peek.adapter, ADAPTERS), None)
+	except ValueError:
+		selected = None
+
+	if selected is not None:
+		_load_adapter(selected)
+
+	parser = _build_parser(ADAPTERS, selected)
 
 	# Actually parse the arguments
 	args = parser.parse_args()
 
+	# Now we know there is something to do, pull in the heavy stuff
+	from . import db
+	from orator import DatabaseManager, Model
+
 	# Initialize the download directory if not done so
 	if not os.path.exists(args.output):
 		wrn(f'Output directory {args.output} does not exist, creating')
@@ -234,15 +460,20 @@ def main():
 	# Initialize the Database
 	dbc = config.DATABASE
 	dbc['trawler_cache']['database'] = args.cache_database
+	dbc['trawler_cache']['timeout'] = args.db_busy_timeout
 
 	if args.adapter == 'zotero':
 		dbc['zotero']['database'] = args.zotero_db_loc
+		dbc['zotero']['timeout'] = args.db_busy_timeout
 
 	dbm = DatabaseManager(config.DATABASE)
 	Model.set_connection_resolver(dbm)
 
-	if not os.path.exists(args.cache_database):
-		common.wrn('Cache database does not exists, creating')
+	cache_exists = os.path.exists(args.cache_database)
+	db.tune_connection(dbm, 'trawler_cache')
+
+	if not cache_exists:
+		wrn('Cache database does not exists, creating')
 		db.run_migrations(dbm)
 	else:
 		# Check the DB schema and update it if need be
@@ -255,37 +486,51 @@ def main():
 		log(f'Datasheet download directory {args.output} does not exist, creating')
 		os.mkdir(args.output)
 
-	# Initialize the profile directory
-	if not os.path.exists(args.profile_directory):
-		log(f'WebDriver profile \'{args.profile_directory}\' does not exist, creating')
-		os.mkdir(args.profile_directory)
+	# Get the adapter we need to run
+	if args.adapter not in map(lambda a: a['name'], ADAPTERS):
+		err(f'Unknown adapter {args.adapter}')
+		err(f'Known adapters: {", ".join(map(lambda a: a["name"], ADAPTERS))}')
+		return 1
+	else:
+		adpt = selected
 
-	# WebDriver Initialization
-	inf(f'Using the {args.webdriver} WebDriver')
-	if args.webdriver == config.WebdriverBackend.Chrome:
-		wd_opts = webdriver.chrome.options.Options()
-		wd = webdriver.Chrome
+	# Only the adapters that drive a browser need selenium
+	wd = None
+	wd_opts = None
+	if not adpt['is_meta'] and adpt['uses_webdriver']:
+		from selenium import webdriver
 
-		wd_opts.add_argument(f'user-data-dir={args.profile_directory}')
+		# Initialize the profile directory
+		if not os.path.exists(args.profile_directory):
+			log(f'WebDriver profile \'{args.profile_directory}\' does not exist, creating')
+			os.mkdir(args.profile_directory)
 
-		if args.headless:
-			wd_opts.add_argument('--headless')
-			wd_opts.add_argument(f'--window-size={args.headless_width},{args.headless_height}')
+		# WebDriver Initialization
+		inf(f'Using the {args.webdriver} WebDriver')
+		if args.webdriver == config.WebdriverBackend.Chrome:
+			wd_opts = webdriver.chrome.options.Options()
+			wd = webdriver.Chrome
 
+			wd_opts.add_argument(f'user-data-dir={args.profile_directory}')
 
-	elif args.webdriver == config.WebdriverBackend.FireFox:
-		wd = webdriver.Firefox
-		wd_opts = webdriver.firefox.options.Options()
+			if args.headless:
+				wd_opts.add_argument('--headless')
+				wd_opts.add_argument(f'--window-size={args.headless_width},{args.headless_height}')
 
-		wd_profile = webdriver.firefox.firefox_profile.FirefoxProfile(args.profile_directory)
-		wd_opts.profile = wd_profile
 
-		if args.headless:
-			wd_opts.headless = True
+		elif args.webdriver == config.WebdriverBackend.FireFox:
+			wd = webdriver.Firefox
+			wd_opts = webdriver.firefox.options.Options()
 
-	else:
-		err('Unknown WebDriver, what?')
-		return 1
+			wd_profile = webdriver.firefox.firefox_profile.FirefoxProfile(args.profile_directory)
+			wd_opts.profile = wd_profile
+
+			if args.headless:
+				wd_opts.headless = True
+
+		else:
+			err('Unknown WebDriver, what?')
+			return 1
 
 	# Ensure the database is properly populated w/ known adapters
 	for adapter in ADAPTERS:
@@ -298,14 +543,6 @@ def main():
 				s.meta = True
 			s.save()
 
-	# Get the adapter we need to run
-	if args.adapter not in map(lambda a: a['name'], ADAPTERS):
-		err(f'Unknown adapter {args.adapter}')
-		err(f'Known adapters: {", ".join(map(lambda a: a["name"], ADAPTERS))}')
-		return 1
-	else:
-		adpt = list(filter(lambda a: a['name'] == args.adapter, ADAPTERS))[0]
-
 	# Initialize the adapter download directory
 	dl_dir = os.path.join(args.output, adpt['name'])
 	if not os.path.exists(dl_dir) and not adpt['is_meta']:
@@ -315,5 +552,11 @@ def main():
 	# Actually run the adapter
 	if adpt['is_meta']:
 		return adpt['main'](args, dl_dir)
-	else:
+
+	from . import net
+	net.set_rate_limits(adpt['rate_limits'], args.rate)
+
+	try:
 		return adpt['main'](args, wd, wd_opts, dl_dir)
+	finally:
+		net.close_sessions()
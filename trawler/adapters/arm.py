@@ -10,6 +10,8 @@ import sys
 import time
 import enum
 
+from urllib.parse import unquote
+
 from enum import Enum, Flag
 from os import getcwd, path, mkdir
 from datetime import datetime, timedelta
@@ -19,10 +21,14 @@ from requests import utils
 
 from tqdm import tqdm
 from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.common.exceptions import NoSuchElementException
 
 from ..common import *
-from ..net import download_resource
-from ..db import Datasheet, DatasheetTag, Scraper
+from ..net import download_stage, plan_downloads, post_json
+from ..db import Datasheet, DatasheetTag, DatasheetBatch, Scraper
+from ..pipeline import Stage, Pipeline
+from ..browser import WebDriverPool, wait_for, element_present, result_count_stable, network_idle, log_wait_stats
 
 @enum.unique
 class DocumentType(Enum):
@@ -60,105 +66,202 @@ class DocumentType(Enum):
 		if self.value == DocumentType.SoftwareErrata.value:
 			return 'Software%20Developer%20Errata%20Notice'
 
+@enum.unique
+class CollectMode(Enum):
+	Browser = enum.auto()
+	HTTP    = enum.auto()
+
+	def __str__(self) -> str:
+		return self.name.lower()
+
+	@staticmethod
+	def from_string(s):
+		for mode in CollectMode:
+			if mode.name.lower() == s.lower():
+				return mode
+		raise ValueError()
+
 
 ADAPTER_NAME = 'arm'
 ADAPTER_DESC = 'arm datasheet adapter'
 
 ARM_DOCS_ROOT_URL = 'https://developer.arm.com/documentation'
-
-
-def extract_datasheet(driver, ds):
+ARM_RESULTS_PER_PAGE = 10
+# How long to give a page to render before giving up on it
+ARM_WAIT_TIMEOUT = 15
+
+ARM_RESULTS_XPATH = '//*[@id="search"]/div[2]/div[2]/div[10]/div/*'
+ARM_DOWNLOAD_BUTTON_XPATH = '/html/body/div/div/div[2]/main/div/div[1]/div/div/div[1]/div/button'
+# The documentation search page is a front end to this
+ARM_SEARCH_URL = 'https://platform.cloud.coveo.com/rest/search/v2'
+ARM_SEARCH_PAGE_SIZE = 1000
+# Fields on each search result that we turn into tags
+ARM_SEARCH_TAG_FIELDS = (
+	'navigationhierarchiescontenttype',
+	'navigationhierarchiesproducts',
+	'navigationhierarchiestopics',
+)
+
+
+def extract_datasheet(driver, ds, timeout = ARM_WAIT_TIMEOUT):
+	"""
+	Find the download link on the datasheet's page, returns None if there isn't one.
+	"""
 	tlog(f'  => Extracting datasheet {ds.id} from {ds.src}')
 	driver.get(ds.src)
-	time.sleep(3.5)
+	if not wait_for(driver, element_present(By.XPATH, ARM_DOWNLOAD_BUTTON_XPATH), timeout, 'document page'):
+		return None
+
 	try:
-		driver.find_element_by_xpath('/html/body/div/div/div[2]/main/div/div[1]/div/div/div[1]/div/button').click()
-		dl_loc = driver.find_element_by_xpath('/html/body/div/div/div[2]/main/div/div[1]/div/div/div[1]/div[2]/a')
-	except Exception as e:
-		if isinstance(e, KeyboardInterrupt):
-			sys.quit()
-		else:
+		driver.find_element(By.XPATH, ARM_DOWNLOAD_BUTTON_XPATH).click()
+		dl_loc = driver.find_element(By.XPATH, '/html/body/div/div/div[2]/main/div/div[1]/div/div/div[1]/div[2]/a')
+	except NoSuchElementException:
+		return None
+
+	return dl_loc.get_attribute('href')
+
+def collect_page(driver, doc_url, page_index, timeout = ARM_WAIT_TIMEOUT):
+	"""
+	Collect the documents on one page of search results, along with whether
+	there is a page after it.
+	"""
+	driver.get(f'{ARM_DOCS_ROOT_URL}/#first={page_index}&{doc_url}')
+	# We need to wait because ajax and frames and just bad, the results are in once
+	# the page stops fetching things and the result cards stop changing
+	wait_for(driver, network_idle(), timeout, 'results page load')
+	wait_for(driver, result_count_stable(By.XPATH, ARM_RESULTS_XPATH), timeout, 'results page')
+
+	docs = []
+	for doc in driver.find_elements(By.XPATH, ARM_RESULTS_XPATH):
+		card_link = doc.find_element(By.XPATH, './/div[1]/div/div[2]/div[1]/div/div/a')
+		try:
+			tags_row = doc.find_element(By.CSS_SELECTOR, 'div.documentTagsContainer')
+		except:
+			tags_row = None
+
+		tags = []
+		if tags_row is not None:
+			for tag in tags_row.find_elements(By.XPATH, './/span'):
+				tags += tag.text.split(' ')
+
+		docs.append((card_link.get_attribute('title'), card_link.get_attribute('href'), tags))
+
+	try:
+		driver.find_element(By.XPATH, '//*[@id="search"]/div[2]/div[2]/div[11]/ul/li[6]')
+		has_next_page = True
+	except NoSuchElementException:
+		has_next_page = False
+
+	return (docs, has_next_page)
+
+def collect_stage(pool, batch, doc_types, timeout = ARM_WAIT_TIMEOUT):
+	"""
+	A pipeline stage that collects pages of search results, given the offset
+	of the first result on the page. Each browser in the pool walks its own
+	share of the pages, and the datasheets found are passed on as they come in.
+	"""
+	dt_string = ','.join(map(lambda dt: (DocumentType.from_string(dt)).filter_name(), doc_types))
+	doc_url = f'sort=relevancy&f:@navigationhierarchiescontenttype=[{dt_string}]'
+	stride = pool.size * ARM_RESULTS_PER_PAGE
+
+	def start(page_index, done):
+		pool.submit(lambda wd, first: collect_page(wd, doc_url, first, timeout), page_index, done)
+
+	def handle(page_index, page, error):
+		if error is not None:
+			terr(f'  => Unable to collect the page of results from {page_index}: {error}')
+			return None
+
+		docs, has_next_page = page
+		if has_next_page:
+			stage.pipeline.feed(stage, [ page_index + stride ])
+
+		for title, url, tags in docs:
+			batch.add(title, tags = tags, src = url)
+
+		# They need to be in the database before anything else can be done with them
+		batch.flush()
+		ids = [ batch.ids[title] for title, _, _ in docs if title in batch.ids ]
+		return Datasheet.where_in('id', ids).get() if len(ids) > 0 else []
+
+	stage = Stage('collect', start, handle, capacity = pool.size)
+	return stage
+
+def extract_stage(pool, timeout = ARM_WAIT_TIMEOUT):
+	"""
+	A pipeline stage that finds the download links for datasheets, the
+	browsers only find them and they get saved out here.
+	"""
+	def start(ds, done):
+		pool.submit(lambda wd, ds: extract_datasheet(wd, ds, timeout), ds, done)
+
+	def handle(ds, url, error):
+		if error is not None or url is None:
 			terr(f'  => Error: Unable to extract datasheet with id {ds.id}')
-			return False
+			return None
+
+		ds.url = url
+		ds.save()
+		return [ ds ]
+
+	return Stage('extract', start, handle, capacity = pool.size)
 
-	ds.url = dl_loc.get_attribute('href')
-	ds.save()
-	return True
 
+def _search_tags(result):
+	raw = result.get('raw', {})
+	tags = []
+	for field in ARM_SEARCH_TAG_FIELDS:
+		values = raw.get(field, [])
+		if isinstance(values, str):
+			values = [ values ]
+		# Hierarchical fields come as 'Parent|Child'
+		for value in values:
+			tags += filter(None, map(str.strip, value.split('|')))
 
+	return tags
 
-def collect_datasheets(driver, doc_types):
+def collect_datasheets_http(args, doc_types):
+	"""
+	Collect the datasheets by querying the search backend directly rather
+	than scraping the rendered search page.
+	"""
 	sc_id = Scraper.where('name', '=', ADAPTER_NAME).first_or_fail().id
 
-	dt_string = ','.join(map(lambda dt: (DocumentType.from_string(dt)).filter_name(), doc_types))
-	doc_url = f'sort=relevancy&f:@navigationhierarchiescontenttype=[{dt_string}]'
-	has_next_page = True
-	page_index = 0
+	content_types = ', '.join(map(lambda dt: f'"{unquote(DocumentType.from_string(dt).filter_name())}"', doc_types))
+	headers = { 'Authorization': f'Bearer {args.arm_search_token}' }
+
+	first = 0
 	datasheets = 0
 	start_time = datetime.now()
 
-	log('Collecting datasheets... this might take a while')
-	while has_next_page:
-		inf(f'  => On page index {(page_index//10)+1}, total so far {datasheets}')
-		# We need to wait because ajax and frames and just bad.
-		driver.get(f'{ARM_DOCS_ROOT_URL}/#first={page_index}&{doc_url}')
-		time.sleep(3)
-
-		doc_list = driver.find_elements_by_xpath('//*[@id="search"]/div[2]/div[2]/div[10]/div/*')
-
-		for doc in doc_list:
-			card_link = doc.find_element_by_xpath('.//div[1]/div/div[2]/div[1]/div/div/a')
-			try:
-				tags_row = doc.find_element_by_css_selector('div.documentTagsContainer')
-			except:
-				tags_row = None
-
-			title = card_link.get_attribute('title')
-			url = card_link.get_attribute('href')
-
-			try:
-				ds = Datasheet \
-					.where('title', '=', title) \
-					.where('scraper_id', '=', sc_id) \
-					.first_or_fail()
-
-			except:
-				ds = Datasheet()
-				ds.scraper_id = sc_id
-				ds.found = datetime.now()
-				ds.src = url
-				ds.title = title
-
-			ds.last_seen = datetime.now()
-			ds.save()
-
-			if tags_row is not None:
-				tags = tags_row.find_elements_by_xpath('.//span')
-				for tag in tags:
-					for t in tag.text.split(' '):
-						if t != '':
-							try:
-								te = DatasheetTag \
-									.where('scraper_id', '=', sc_id) \
-									.where('name', '=', t) \
-									.first_or_fail()
-							except:
-								te = DatasheetTag()
-								te.scraper_id = sc_id
-								te.name = t
-								te.save()
-
-							ds.add_tag(te)
-
-			ds.save()
-
-			datasheets += 1
-
-		try:
-			driver.find_element_by_xpath('//*[@id="search"]/div[2]/div[2]/div[11]/ul/li[6]')
-			page_index += 10
-		except:
-			has_next_page = False
+	log('Collecting datasheets from the search backend')
+	with DatasheetBatch(sc_id) as batch:
+		while True:
+			inf(f'  => From result {first}, total so far {datasheets}')
+			res = post_json(args.arm_search_url, args, {
+				'q': '',
+				'aq': f'@navigationhierarchiescontenttype==({content_types})',
+				'sortCriteria': 'relevancy',
+				'firstResult': first,
+				'numberOfResults': args.arm_page_size,
+			}, headers = headers)
+
+			if res is None:
+				err('Unable to query the ARM documentation search')
+				break
+
+			results = res.get('results', [])
+			for result in results:
+				url = result.get('clickUri') or result.get('uri')
+				if not result.get('title') or not url:
+					continue
+
+				batch.add(result['title'], tags = _search_tags(result), src = url)
+				datasheets += 1
+
+			first += len(results)
+			if len(results) == 0 or first >= res.get('totalCount', 0):
+				break
 
 	end_time = datetime.now()
 
@@ -177,32 +280,89 @@ def parser_init(parser):
 		help = 'ARM Documentation types to download'
 	)
 
+	arm_options.add_argument(
+		'--arm-collect-mode',
+		dest = 'arm_collect_mode',
+		type = CollectMode.from_string,
+		choices = list(CollectMode),
+		default = 'browser',
+		help = 'Collect datasheets by driving the search page in a browser, or by querying the search backend over HTTP'
+	)
+
+	arm_options.add_argument(
+		'--arm-wait-timeout',
+		dest = 'arm_wait_timeout',
+		type = float,
+		default = ARM_WAIT_TIMEOUT,
+		help = 'How long in seconds to wait for a page to render in the browser'
+	)
+
+	arm_options.add_argument(
+		'--arm-search-url',
+		dest = 'arm_search_url',
+		type = str,
+		default = ARM_SEARCH_URL,
+		help = 'Search backend to query when collecting over HTTP'
+	)
+
+	arm_options.add_argument(
+		'--arm-search-token',
+		dest = 'arm_search_token',
+		type = str,
+		default = None,
+		help = 'Access token for the search backend, as used by the documentation search page, without one datasheets are collected in the browser'
+	)
+
+	arm_options.add_argument(
+		'--arm-page-size',
+		dest = 'arm_page_size',
+		type = int,
+		default = ARM_SEARCH_PAGE_SIZE,
+		help = 'Number of search results to request at once when collecting over HTTP'
+	)
+
 def adapter_main(args, driver, driver_options, dl_dir):
 	sc_id = Scraper.where('name', '=', ADAPTER_NAME).first_or_fail().id
-	if not args.skip_collect or not args.skip_extract:
-		with driver(options = driver_options) as wd:
-			if not args.skip_collect:
-				collect_datasheets(wd, args.arm_doc_type)
-
-			if not args.skip_extract:
-				sheets = Datasheet.where('src', '!=', 'NULL').where('scraper_id', '=', sc_id).get()
-				with tqdm(
-						miniters = 1, total = len(sheets),
-					) as bar:
-						for ds in sheets:
-							bar.set_description(fixup_title(ds.title))
-							if extract_datasheet(wd, ds):
-								bar.update(1)
-
-	if not args.skip_download:
-		sheets = Datasheet.where('url', '!=', 'NULL').where('scraper_id', '=', sc_id).get()
-		with tqdm(
-				miniters = 1, total = len(sheets),
-			) as bar:
-				for ds in sheets:
-					bar.set_description(fixup_title(ds.title))
-					if download_resource(dl_dir, ds, args):
-						bar.update(1)
 
+	collect_mode = args.arm_collect_mode
+	if collect_mode == CollectMode.HTTP and args.arm_search_token is None:
+		# The search backend turns away anything without a token
+		wrn('No \'--arm-search-token\' given for the search backend, collecting in the browser instead')
+		collect_mode = CollectMode.Browser
+	collect_in_browser = not args.skip_collect and collect_mode == CollectMode.Browser
+
+	# This is only a handful of requests, so it's done up front
+	if not args.skip_collect and collect_mode == CollectMode.HTTP:
+		collect_datasheets_http(args, args.arm_doc_type)
+
+	with WebDriverPool(driver, driver_options, args) as pool, DatasheetBatch(sc_id) as batch:
+		stages = []
+		if collect_in_browser:
+			log('Collecting datasheets... this might take a while')
+			stages.append(collect_stage(pool, batch, args.arm_doc_type, args.arm_wait_timeout))
+		if not args.skip_extract:
+			stages.append(extract_stage(pool, args.arm_wait_timeout))
+		if not args.skip_download:
+			stages.append(download_stage(dl_dir, args))
+
+		if len(stages) == 0:
+			return 0
+
+		pipeline = Pipeline(stages, args.queue_size)
+
+		# Whatever the first stage is, it starts from what we already have
+		if collect_in_browser:
+			pipeline.feed(stages[0], [ i * ARM_RESULTS_PER_PAGE for i in range(pool.size) ])
+		elif not args.skip_extract:
+			pipeline.feed(stages[0], Datasheet.where('src', '!=', 'NULL').where('scraper_id', '=', sc_id).get())
+
+		# If nothing is being extracted, we still want what was extracted last time
+		if not args.skip_download and args.skip_extract:
+			pipeline.feed(stages[-1], plan_downloads(Datasheet.where('url', '!=', 'NULL').where('scraper_id', '=', sc_id).get(), args))
+
+		pipeline.run()
+
+	if collect_in_browser or not args.skip_extract:
+		log_wait_stats()
 
 	return 0
@@ -0,0 +1,166 @@
+# SPDX-License-Identifier: BSD-3-Clause
+"""
+query.py
+--------
+
+This is the query meta adapter, it looks up datasheets in the Trawler cache
+
+"""
+import sqlite3
+
+from datetime import datetime
+
+from ..common import *
+from ..db import Datasheet
+
+
+META_ADAPTER = 0
+
+ADAPTER_NAME = 'query'
+ADAPTER_DESC = 'Trawler datasheet lookup meta adapter'
+
+QUERY_DEFAULT_LIMIT = 20
+
+# How much a match in each of the indexed columns counts towards the rank, in the
+# order they are in the index: title, tags, vendor and filename
+QUERY_COLUMN_WEIGHTS = (10.0, 5.0, 2.0, 1.0)
+
+def _quote(term):
+	return '"' + term.replace('"', '""') + '"'
+
+def build_match(terms, exact = False):
+	"""
+	Turn the search terms into an FTS5 match expression, any term with spaces
+	in it is searched for as a phrase, and the rest as prefixes unless `exact`.
+	"""
+	match = []
+	for term in terms:
+		term = term.strip()
+		if term == '':
+			continue
+
+		if exact or any(map(str.isspace, term)):
+			match.append(_quote(term))
+		else:
+			match.append(f'{_quote(term)}*')
+
+	return ' AND '.join(match)
+
+def search(terms, tags = (), scrapers = (), limit = QUERY_DEFAULT_LIMIT, exact = False, raw = False):
+	"""
+	Look up datasheets matching the terms, best match first. Returns the rows
+	with their id, title, vendor, url and where they were downloaded to, if they were.
+	"""
+	match = ' '.join(terms) if raw else build_match(terms, exact)
+
+	query = 'SELECT d.id, d.title, s.name AS vendor, d.url, d.dl_location, d.downloaded FROM '
+	params = []
+	if match != '':
+		query += (
+			'datasheet_search INNER JOIN datasheets d ON d.id = datasheet_search.rowid '
+			'INNER JOIN scrapers s ON s.id = d.scraper_id WHERE datasheet_search MATCH ?'
+		)
+		params.append(match)
+	else:
+		query += 'datasheets d INNER JOIN scrapers s ON s.id = d.scraper_id WHERE 1'
+
+	if len(scrapers) > 0:
+		query += f' AND s.name IN ({", ".join("?" * len(scrapers))})'
+		params += list(scrapers)
+
+	# Every tag has to be on the datasheet
+	for tag in tags:
+		query += (
+			' AND d.id IN (SELECT tl.datasheet_id FROM tag_links tl '
+			'INNER JOIN datasheet_tags t ON t.id = tl.tag_id WHERE t.name = ?)'
+		)
+		params.append(tag)
+
+	if match != '':
+		query += f' ORDER BY bm25(datasheet_search, {", ".join(map(str, QUERY_COLUMN_WEIGHTS))})'
+	else:
+		query += ' ORDER BY d.title'
+
+	if limit > 0:
+		query += f' LIMIT {int(limit)}'
+
+	cur = Datasheet.resolve_connection(Datasheet.__connection__).get_connection().cursor()
+	cur.row_factory = sqlite3.Row
+	cur.execute(query, params)
+	return cur.fetchall()
+
+# ==== Adapter Methods ==== #
+
+def parser_init(parser):
+	query_options = parser.add_argument_group('query meta adapter options')
+
+	query_options.add_argument(
+		'terms',
+		type = str,
+		nargs = '*',
+		help = 'What to search for in the datasheet titles, tags, vendors and file names, quote a term to search for it as a phrase'
+	)
+
+	query_options.add_argument(
+		'--tag',
+		dest = 'query_tags',
+		type = str,
+		default = [],
+		action = 'append',
+		help = 'Only show datasheets with the given tag, can be given multiple times'
+	)
+
+	query_options.add_argument(
+		'--scraper',
+		dest = 'query_scrapers',
+		type = str,
+		default = [],
+		action = 'append',
+		help = 'Only show datasheets from the given adapter, can be given multiple times'
+	)
+
+	query_options.add_argument(
+		'--limit',
+		dest = 'query_limit',
+		type = int,
+		default = QUERY_DEFAULT_LIMIT,
+		help = 'The most datasheets to show, 0 for all of them'
+	)
+
+	query_options.add_argument(
+		'--exact',
+		dest = 'query_exact',
+		default = False,
+		action = 'store_true',
+		help = 'Only match whole words, rather than words starting with the search terms'
+	)
+
+	query_options.add_argument(
+		'--raw',
+		dest = 'query_raw',
+		default = False,
+		action = 'store_true',
+		help = 'Pass the search terms through as an SQLite FTS5 query as-is'
+	)
+
+def adapter_main(args, dl_dir):
+	if len(args.terms) == 0 and len(args.query_tags) == 0:
+		err('Nothing to search for, give some search terms or a \'--tag\'')
+		return 1
+
+	start_time = datetime.now()
+	try:
+		results = search(
+			args.terms, args.query_tags, args.query_scrapers,
+			args.query_limit, args.query_exact, args.query_raw
+		)
+	except sqlite3.OperationalError as e:
+		err(f'Unable to run the search: {e}')
+		return 1
+
+	for ds in results:
+		print(f'[{ds["vendor"]}] {ds["title"]}')
+		print(f'    {ds["dl_location"] if ds["downloaded"] else ds["url"]}')
+
+	inf(f'Found {len(results)} datasheets in {(datetime.now() - start_time).total_seconds() * 1000:.1f}ms')
+	return 0
@@ -14,6 +14,7 @@ import re
 from enum import Enum, Flag
 from os import getcwd, path, mkdir
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from requests import utils
@@ -21,67 +22,102 @@ from requests import utils
 from tqdm import tqdm
 
 from ..common import *
-from ..net import download_resource, get_content
-from ..db import Datasheet, DatasheetTag, Scraper
+from ..net import download_resources, plan_downloads, get_content
+from ..db import Datasheet, DatasheetTag, DatasheetBatch, Scraper
 
 from bs4 import BeautifulSoup
 
 ADAPTER_NAME = 'renesas'
 ADAPTER_DESC = 'Renesas datasheet adapter'
+# Everything here is plain HTTP, so there is no need for a browser
+USES_WEBDRIVER = False
 
 RENESAS_ROOT = 'https://www.renesas.com'
 RENESAS_DOCS_ROOT = f'{RENESAS_ROOT}/us/en/support/document-search'
+RENESAS_PAGE_RE = re.compile(r'[?&]page=(\d+)')
+RENESAS_PAGES_IN_FLIGHT = 4
+
+# The search pages are slow to come back rather than rate limited, so let a full set of them go out at once
+RATE_LIMITS = {
+	'www.renesas.com': (2.0, RENESAS_PAGES_IN_FLIGHT),
+}
+
+def _parse_page(args, page_index):
+	"""
+	Fetch and parse one page of the document search, returns the documents on
+	it and whether the pager says this is the last page, or None for the
+	documents if we've run off the end.
+	"""
+	content = get_content(f'{RENESAS_DOCS_ROOT}?page={page_index}', args)
+	if content is False:
+		twrn(f'  => Unable to fetch page index {page_index+1}, stopping here')
+		return (None, True)
+
+	soup = BeautifulSoup(content, 'lxml')
+	table = soup.find('table')
+	if table is None or table.find('tbody') is None:
+		return (None, True)
+
+	docs = []
+	for doc in table.find('tbody').find_all('tr'):
+		tds = doc.find_all('td')
+		is_locked = tds[0].find('span') is not None
+		link = tds[1].find_all('a')[1]
+
+		if not is_locked:
+			docs.append((link.text, link['href']))
+
+	# If the pager doesn't link to anything past this page, then this is the last one
+	pages = [ int(m.group(1)) for m in map(lambda a: RENESAS_PAGE_RE.search(a['href']), soup.select('.pager a[href], nav a[href]')) if m ]
+	is_last = len(pages) > 0 and max(pages) <= page_index
+
+	return (docs, is_last)
 
 def collect_datasheets(args, dl_dir):
 	sc_id = Scraper.where('name', '=', ADAPTER_NAME).first_or_fail().id
 	log('Collecting datasheets... this might take a while')
 
-	page_index = 0
-	has_next_page = True
 	datasheets = 0
 	start_time = datetime.now()
-
-	while has_next_page:
-		inf(f'  => On page index {page_index+1}, total so far {datasheets}')
-		url = f'{RENESAS_DOCS_ROOT}?page={page_index}'
-
-		content = get_content(url, args)
-		soup = BeautifulSoup(content, 'lxml')
-		try:
-			doc_tab = soup.find('table').find('tbody')
-		except Exception as e:
-			if isinstance(e, KeyboardInterrupt):
-				sys.quit()
-			else:
-				has_next_page = False
+	in_flight = max(args.renesas_pages_in_flight, 1)
+
+	with DatasheetBatch(sc_id) as batch, ThreadPoolExecutor(max_workers = in_flight) as pool:
+		pages = {}
+		next_page = 0
+
+		def fill():
+			nonlocal next_page
+			while len(pages) < in_flight:
+				pages[next_page] = pool.submit(_parse_page, args, next_page)
+				next_page += 1
+
+		# Pages come back in whatever order, but are written out in page order
+		page_index = 0
+		fill()
+		while page_index in pages:
+			docs, is_last = pages.pop(page_index).result()
+			if docs is None:
 				break
 
-		for doc in tqdm(doc_tab.find_all('tr')):
-			tds = doc.find_all('td')
-			is_locked = tds[0].find('span') is not None
-			url = tds[1].find_all('a')[1]['href']
-			title = tds[1].find_all('a')[1].text
-
-			if not is_locked:
-				try:
-					ds = Datasheet \
-						.where('title', '=', title) \
-						.where('scraper_id', '=', sc_id) \
-						.first_or_fail()
-				except:
-					ds = Datasheet()
-					ds.scraper_id = sc_id
-					ds.found = datetime.now()
-					ds.src = f'{RENESAS_ROOT}/{url}'
-					ds.url = f'{RENESAS_ROOT}/{url}'
-					ds.dl_location = dl_dir
-					ds.title = title
-
-				ds.last_seen = datetime.now()
-				ds.save()
+			inf(f'  => On page index {page_index+1}, total so far {datasheets}')
+			for title, url in docs:
+				batch.add(
+					title,
+					src = f'{RENESAS_ROOT}/{url}',
+					url = f'{RENESAS_ROOT}/{url}',
+					dl_location = dl_dir
+				)
 				datasheets += 1
 
-		page_index += 1
+			if is_last:
+				break
+
+			page_index += 1
+			fill()
+
+		# Anything past the end that we speculatively asked for can go
+		for fut in pages.values():
+			fut.cancel()
 
 	end_time = datetime.now()
 
@@ -91,6 +127,14 @@ def collect_datasheets(args, dl_dir):
 def parser_init(parser):
 	renesas_options = parser.add_argument_group('Renesas adapter options')
 
+	renesas_options.add_argument(
+		'--pages-in-flight',
+		dest = 'renesas_pages_in_flight',
+		type = int,
+		default = RENESAS_PAGES_IN_FLIGHT,
+		help = 'Number of search result pages to fetch at once, raising this past the default also needs a bigger burst from \'--rate\''
+	)
+
 def adapter_main(args, driver, driver_options, dl_dir):
 	sc_id = Scraper.where('name', '=', ADAPTER_NAME).first_or_fail().id
 
@@ -98,13 +142,7 @@ def adapter_main(args, driver, driver_options, dl_dir):
 		collect_datasheets(args, dl_dir)
 
 	if not args.skip_download:
-		sheets = Datasheet.where('src', '!=', 'NULL').where('scraper_id', '=', sc_id).get()
-		with tqdm(
-				miniters = 1, total = len(sheets),
-			) as bar:
-				for ds in sheets:
-					bar.set_description(fixup_title(ds.title))
-					if download_resource(dl_dir, ds, args):
-						bar.update(1)
+		sheets = plan_downloads(Datasheet.where('src', '!=', 'NULL').where('scraper_id', '=', sc_id).get(), args)
+		download_resources(dl_dir, sheets, args)
 
 	return 0
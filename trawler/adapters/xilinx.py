@@ -9,6 +9,8 @@ This script is designed to scrape all of the datasheets from xilinx.com
 import sys
 import time
 import enum
+import json
+import hashlib
 
 from enum import Enum, Flag
 from os import getcwd, path, mkdir
@@ -18,13 +20,12 @@ import requests
 from requests import utils
 
 from tqdm import tqdm
-from selenium import webdriver
 
 from ..common import *
-from ..net import download_resource, get_content
-from ..db import Datasheet, DatasheetTag, Scraper
+from ..net import download_resources, plan_downloads, get_stream
+from ..db import Datasheet, DatasheetTag, DatasheetBatch, Scraper, SourceDigests, get_metadata, set_metadata
 
-from bs4 import BeautifulSoup
+from lxml import etree
 
 @enum.unique
 class DocumentSource(Enum):
@@ -48,6 +49,21 @@ XILINX_DOCNAV_ROOT = 'https://xilinx.com/support/documentation/navigator'
 XILINX_HUBS_INDEX = f'{XILINX_DOCNAV_ROOT}/xhubs.xml'
 XILINX_DOCS_INDEX = f'{XILINX_DOCNAV_ROOT}/xdocs.xml'
 
+XILINX_INDEX_ETAG = 'xilinx_docnav_etag'
+XILINX_INDEX_MODIFIED = 'xilinx_docnav_last_modified'
+
+# What a datasheet is reset to when its document moves, so it gets downloaded again from the new location
+XILINX_DOWNLOAD_RESET = {
+	'downloaded': False,
+	'filename': None,
+	'etag': None,
+	'last_modified': None,
+	'content_length': None,
+	'sha256': None,
+	'dl_error': None,
+	'dl_error_permanent': False,
+}
+
 def extract_datasheet(driver, ds):
 	tlog(f'  => Extracting datasheet {ds.id} from {ds.src}')
 
@@ -55,153 +71,192 @@ def collect_datasheets(driver, doc_types):
 	sc_id = Scraper.where('name', '=', ADAPTER_NAME).first_or_fail().id
 
 
-def docnav_collect_docs(args):
-	log(f'Downloading doc index from {XILINX_DOCS_INDEX}')
-	catalogs = []
-	content = get_content(XILINX_DOCS_INDEX, args)
-	soup = BeautifulSoup(content, 'lxml')
-	for catalog in soup.find_all('catalog'):
-		# ニャ！
-		cat = {
-			'catalog': catalog['label'],
-			'product': catalog['productName'] if 'productName' in catalog else catalog['productname'],
-			'collection': catalog['collection'],
-			'groups': []
-		}
-
-		inf(f'  => Found catalog {cat["catalog"]}')
-		for group in catalog.find_all('group'):
-			grp = {
-				'title': group['label'],
-				'docs': []
-			}
-
-			inf(f'      => Found group {grp["title"]}')
-			for doc in group.find_all('document'):
-				title = doc.find('title')
-				loc = doc.find('webLocation')
-				doc_id = doc.find('docID')
-				doc_type = doc.find('docType')
-				desc = doc.find('tooltip')
-				tags = doc.find('functionTags')
-
-				grp['docs'].append({
-					'title': title.get_text() if title is not None else '',
-					'location': loc.get_text() if loc is not None  else '',
-					'doc_id': doc_id.get_text()  if doc_id is not None else '',
-					'type': doc_type.get_text() if doc_type is not None  else '',
-					'desc': desc.get_text() if desc is not None else '',
-					'tags': tags.get_text().split(',') if tags is not None else [],
-				})
-
-			cat['groups'].append(grp)
-		catalogs.append(cat)
-
-	return catalogs
+def _doc_key(doc):
+	return doc['doc_id'] or doc['location'] or doc['title']
+
+def _doc_record(args, doc):
+	# What we keep of a document while the rest of the index goes past, the first
+	# group it's listed under is where it gets downloaded to
+	return {
+		'title': doc['title'],
+		'location': doc['location'],
+		'catalog': doc['catalog'],
+		'group': doc['group'],
+		'tags': {},
+		# Whether we group the docs changes where they end up, so that counts too
+		'digest': hashlib.sha256(json.dumps({ 'grouped': not args.xilinx_doc_group }).encode('utf-8')),
+	}
+
+def _local_name(elem):
+	# DocNav isn't consistent with its capitalization, so neither are we
+	return etree.QName(elem).localname.lower()
+
+def docnav_iter_docs(stream):
+	"""
+	Incrementally parse the DocNav index from `stream`, yielding each document
+	as soon as it has been read. Anything already handed out is dropped from the
+	tree as we go, so the parse itself doesn't grow with the size of the index.
+	"""
+	cat = None
+	grp = None
+
+	for event, elem in etree.iterparse(stream, events = ('start', 'end')):
+		name = _local_name(elem)
+
+		if event == 'start':
+			if name == 'catalog':
+				# ニャ！
+				attrs = { k.lower(): v for k, v in elem.attrib.items() }
+				cat = {
+					'catalog': attrs.get('label', ''),
+					'product': attrs.get('productname', ''),
+					'collection': attrs.get('collection', ''),
+				}
+				inf(f'  => Found catalog {cat["catalog"]}')
+			elif name == 'group':
+				grp = elem.get('label', '')
+				inf(f'      => Found group {grp}')
+			continue
+
+		if name == 'document' and cat is not None and grp is not None:
+			fields = { _local_name(child): (child.text or '').strip() for child in elem if isinstance(child.tag, str) }
+
+			yield dict(cat,
+				group = grp,
+				title = fields.get('title', ''),
+				location = fields.get('weblocation', ''),
+				doc_id = fields.get('docid', ''),
+				type = fields.get('doctype', ''),
+				desc = fields.get('tooltip', ''),
+				tags = fields['functiontags'].split(',') if 'functiontags' in fields else [],
+			)
+
+		if name in ('document', 'group', 'catalog'):
+			# Throw away what we've handled, and any siblings before it that are still hanging around
+			elem.clear()
+			while elem.getprevious() is not None:
+				del elem.getparent()[0]
+
+def docnav_fold_docs(args, docs):
+	"""
+	DocNav lists a document under every group it is in, so fold the listings for
+	each document into one small record as they stream past, holding where it was
+	first listed, every catalog, group and tag it has, and a running digest of them all.
+	"""
+	folded = {}
+	for doc in docs:
+		key = _doc_key(doc)
+		rec = folded.get(key)
+		if rec is None:
+			rec = folded[key] = _doc_record(args, doc)
+
+		rec['digest'].update(json.dumps(doc, sort_keys = True).encode('utf-8'))
+		rec['tags'].update(dict.fromkeys([ doc['catalog'], doc['group'] ] + doc['tags']))
+	return folded
 
 def docnav_populate(args, docs, dl_dir):
+	"""
+	Bring the datasheet database in line with the index in `docs`. A document can
+	be listed anywhere in the index, so nothing is written until it has all been
+	read. Documents that are unchanged since the last sync are skipped, and anything
+	that is no longer in the index is removed.
+	"""
 	inf('Populating datasheet database')
 	sc_id = Scraper.where('name', '=', ADAPTER_NAME).first_or_fail().id
-	for cat in docs:
-		inf(f'  => Populating from catalog {cat["catalog"]}')
-		try:
-			cat_tag = DatasheetTag \
-					.where('scraper_id', '=', sc_id) \
-					.where('name', '=', cat['catalog']) \
-					.first_or_fail()
-		except:
-			cat_tag = DatasheetTag()
-			cat_tag.scraper_id = sc_id
-			cat_tag.name = cat['catalog']
-			cat_tag.save()
-
-		for grp in cat['groups']:
-			inf(f'      => Populating {len(grp["docs"])} docs from group {cat["catalog"]}/{grp["title"]}')
-			try:
-				grp_tag = DatasheetTag \
-						.where('scraper_id', '=', sc_id) \
-						.where('name', '=', grp['title']) \
-						.first_or_fail()
-			except:
-				grp_tag = DatasheetTag()
-				grp_tag.scraper_id = sc_id
-				grp_tag.name = grp['title']
-				grp_tag.save()
-
-			for doc in grp['docs']:
-				try:
-					ds = Datasheet \
-						.where('title', '=', doc['title']) \
-						.where('scraper_id', '=', sc_id) \
-						.first_or_fail()
-
-				except:
-					ds = Datasheet()
-					ds.scraper_id = sc_id
-					ds.found = datetime.now()
-					ds.src = doc['location']
-					ds.url = doc['location']
-					ds.title = doc['title']
-
-				if not args.xilinx_doc_group:
-					c_dir = path.join(dl_dir, cat['catalog'].replace('/', '_'))
-					g_dir = path.join(c_dir, grp['title'].replace('/', '_'))
+	populated = 0
+	unchanged = 0
+	known_dirs = set()
+	digests = SourceDigests(sc_id)
+	pending = []
+	known_urls = {
+		ds.title: ds.url for ds in Datasheet.where('scraper_id', '=', sc_id).get(['title', 'url'])
+	}
+
+	# NOTE: Existing datasheets keep their dl_location, it points at the downloaded file by now,
+	# unless the document has moved and we have to fetch it again
+	update = ('last_seen', 'src', 'url', 'dl_location') + tuple(XILINX_DOWNLOAD_RESET)
+	with DatasheetBatch(sc_id, update = update, replace_tags = True) as batch:
+		for key, doc in docnav_fold_docs(args, docs).items():
+			digest = doc['digest'].hexdigest()
+			if not digests.check(key, digest) and not args.xilinx_full_sync:
+				unchanged += 1
+				continue
+
+			pending.append((key, digest, doc['title']))
+
+			g_dir = None
+			if not args.xilinx_doc_group:
+				c_dir = path.join(dl_dir, doc['catalog'].replace('/', '_'))
+				g_dir = path.join(c_dir, doc['group'].replace('/', '_'))
+				if g_dir not in known_dirs:
 					if not path.exists(c_dir):
-						log(f'  => Catalog {cat["catalog"]} does not exist, creating')
+						log(f'  => Catalog {doc["catalog"]} does not exist, creating')
 						mkdir(c_dir)
 
 					if not path.exists(g_dir):
-						log(f'  => Group {cat["catalog"]}/{grp["title"]} does not exist, creating')
+						log(f'  => Group {doc["catalog"]}/{doc["group"]} does not exist, creating')
 						mkdir(g_dir)
 
-					ds.dl_location = g_dir
-				ds.save()
-
-				ds.add_tag(cat_tag)
-				ds.add_tag(grp_tag)
-				for tag in doc['tags']:
-					if tag != '':
-						try:
-							ds_tag = DatasheetTag \
-									.where('scraper_id', '=', sc_id) \
-									.where('name', '=', tag) \
-									.first_or_fail()
-						except:
-							ds_tag = DatasheetTag()
-							ds_tag.scraper_id = sc_id
-							ds_tag.name = tag
-							ds_tag.save()
-
-						ds.add_tag(ds_tag)
-				ds.save()
+					known_dirs.add(g_dir)
+
+			fields = {}
+			if doc['title'] not in known_urls:
+				fields['dl_location'] = g_dir
+			elif known_urls[doc['title']] != doc['location']:
+				fields.update(XILINX_DOWNLOAD_RESET, dl_location = g_dir)
+
+			batch.add(
+				doc['title'],
+				tags = list(doc['tags']),
+				src = doc['location'],
+				url = doc['location'],
+				**fields
+			)
+			populated += 1
+
+	# Only now that the datasheets have been written out are the digests safe to keep
+	for key, digest, title in pending:
+		if title in batch.ids:
+			digests.record(key, digest, batch.ids[title])
+
+	removed = digests.save(prune = True)
+
+	inf(f'Populated {populated} datasheets, {unchanged} unchanged, {removed} removed')
 
 def docnav_runner(args, dl_dir):
 	inf('Downloading datasheets from DocNav')
 	sc = Scraper.where('name', '=', ADAPTER_NAME).first_or_fail()
 
 	if not args.skip_collect:
-		docs = docnav_collect_docs(args)
-		if docs is None:
+		log(f'Downloading doc index from {XILINX_DOCS_INDEX}')
+		headers = {}
+		if not args.xilinx_full_sync:
+			etag = get_metadata(XILINX_INDEX_ETAG)
+			last_modified = get_metadata(XILINX_INDEX_MODIFIED)
+			if etag:
+				headers['If-None-Match'] = etag
+			if last_modified:
+				headers['If-Modified-Since'] = last_modified
+
+		index = get_stream(XILINX_DOCS_INDEX, args, headers = headers)
+		if index is None:
 			err('Unable to collect Xilinx hubs')
 			return 1
 
-		# Populate the datasheet database
-		docnav_populate(args, docs, dl_dir)
+		with index:
+			if index.status_code == 304:
+				inf('Doc index is unchanged since the last sync')
+			else:
+				# Populate the datasheet database as the index comes in
+				docnav_populate(args, docnav_iter_docs(index.raw), dl_dir)
+
+				set_metadata(XILINX_INDEX_ETAG, index.headers.get('ETag'))
+				set_metadata(XILINX_INDEX_MODIFIED, index.headers.get('Last-Modified'))
 
 	# Now we have all the datasheets, we can download them
 	if not args.skip_download:
-		sheets = Datasheet.where('url', '!=', 'NULL').where('scraper_id', '=', sc.id).get()
-		with tqdm(
-				miniters = 1, total = len(sheets),
-			) as bar:
-				for ds in sheets:
-					bar.set_description(fixup_title(ds.title))
-					if ds.url[-4:] == 'html' and args.xilinx_get_web_only:
-						if download_resource(dl_dir, ds, args):
-							bar.update(1)
-					else:
-						if download_resource(dl_dir, ds, args):
-							bar.update(1)
+		sheets = plan_downloads(Datasheet.where('url', '!=', 'NULL').where('scraper_id', '=', sc.id).get(), args)
+		download_resources(dl_dir, sheets, args)
 
 	sc.last_run = datetime.now()
 	sc.save()
@@ -245,6 +300,14 @@ def parser_init(parser):
 		help = 'Don\'t group the datasheets when using DocNav as the document source'
 	)
 
+	xilinx_options.add_argument(
+		'--full-sync',
+		dest = 'xilinx_full_sync',
+		default = False,
+		action = 'store_true',
+		help = 'Re-read every document in the DocNav index, even if it hasn\'t changed since the last sync'
+	)
+
 	xilinx_options.add_argument(
 		'--collect-web-only', '-W',
 		dest = 'xilinx_get_web_only',
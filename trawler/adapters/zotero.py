@@ -8,19 +8,22 @@ This is the zotero meta adapter
 """
 import sys
 import os
+import json
+import gzip
+import shutil
+import sqlite3
 
-from shutil import copyfile
 from tempfile import gettempdir
 from datetime import datetime
-
-from orator import Model, orm
+from hashlib import sha256
 
 from tqdm import tqdm
 
+from orator import Model, orm
+
 from .. import config
 from ..common import *
-from ..net import download_resource
-from ..db import Datasheet, DatasheetTag, Scraper
+from ..db import Datasheet, Scraper, ZoteroLedger, transaction, get_metadata, set_metadata
 
 
 META_ADAPTER = 0
@@ -29,12 +32,30 @@ ADAPTER_NAME = 'zotero'
 ADAPTER_DESC = 'Trawler zotero meta adapter'
 
 ZOTERO_BACKUP_DIR = gettempdir()
+ZOTERO_BACKUP_NAME = 'zotero_backup'
+# How many database pages to copy per step of a backup, and how many backups to keep around
+ZOTERO_BACKUP_PAGES = 4096
+ZOTERO_BACKUP_KEEP = 3
+# Cache metadata key for what the Zotero database looked like at the last backup
+ZOTERO_BACKUP_STATE = 'zotero_backup_state'
 ZOTERO_TRAWLER_ROOT_COLLECTION = 'Trawler'
 
+# The item types and fields we fill in
+ZOTERO_ITEM_TYPE = 12
+ZOTERO_ATTACHMENT_TYPE = 2
+ZOTERO_FIELD_TITLE = 1
+ZOTERO_FIELD_ACCESSED = 6
+ZOTERO_FIELD_URL = 13
+# Our tags go in as automatic ones, so we can tell them apart from the ones the user added
+ZOTERO_TAG_AUTOMATIC = 1
+
+# Keep well under SQLite's limit on the number of parameters in a statement
+ZOTERO_CHUNK_SIZE = 500
+
 def gen_key(key_len = 8):
-	from random import choice
+	from random import choices
 	from string import ascii_uppercase, digits
-	return ''.join(choice(ascii_uppercase + digits) for i in range(key_len))
+	return ''.join(choices(ascii_uppercase + digits, k = key_len))
 
 # ==== Zotero DB Models ==== #
 
@@ -160,14 +181,129 @@ class ZItemDataValue(Model):
 		return self.item_data().where('valueID', '=', self.valueID).exists()
 
 
-# ==== Adapter Methods ==== #
-
-def sync_scraper(tcol, sc):
-	log(f'  => Syncing datasheets from {sc.name}')
-	date_added = datetime.now()
+# ==== Bulk Sync ==== #
+
+def _chunks(items, size = ZOTERO_CHUNK_SIZE):
+	items = list(items)
+	for i in range(0, len(items), size):
+		yield items[i:i + size]
+
+def _select_in(cur, query, values):
+	# Run `query` with its `{}` replaced by an IN list, a chunk of `values` at a time
+	for chunk in _chunks(values):
+		cur.execute(query.format(', '.join('?' * len(chunk))), chunk)
+		yield from cur.fetchall()
+
+class ZoteroWriter:
+	"""
+	Bulk writes into the Zotero database over a single cursor, all of the
+	lookups are done a whole set at a time rather than per item.
+	"""
+
+	def __init__(self, cur):
+		self.cur = cur
+		# The connection hands back its own dict rows, which are far too slow for this many
+		self.cur.row_factory = sqlite3.Row
+		self.keys = None
+
+	def value_ids(self, values):
+		"""
+		Get the valueIDs for `values`, adding any that Zotero doesn't have yet.
+		"""
+		values = list(set(values))
+		self.cur.executemany('INSERT OR IGNORE INTO itemDataValues (value) VALUES (?)', [ (v,) for v in values ])
+		return { row['value']: row['valueID'] for row in _select_in(self.cur, 'SELECT valueID, value FROM itemDataValues WHERE value IN ({})', values) }
+
+	def tag_ids(self, names):
+		names = list(set(names))
+		self.cur.executemany('INSERT OR IGNORE INTO tags (name) VALUES (?)', [ (n,) for n in names ])
+		return { row['name']: row['tagID'] for row in _select_in(self.cur, 'SELECT tagID, name FROM tags WHERE name IN ({})', names) }
+
+	def _new_key(self):
+		if self.keys is None:
+			self.cur.execute('SELECT key FROM items')
+			self.keys = { row['key'] for row in self.cur.fetchall() }
+
+		key = gen_key()
+		while key in self.keys:
+			key = gen_key()
+		self.keys.add(key)
+		return key
+
+	def new_items(self, item_type, library_id, count):
+		"""
+		Create `count` new items, returns their itemIDs.
+		"""
+		keys = [ self._new_key() for _ in range(count) ]
+		self.cur.executemany(
+			'INSERT INTO items (itemTypeID, libraryID, key) VALUES (?, ?, ?)',
+			[ (item_type, library_id, key) for key in keys ]
+		)
+		# Keys are only unique within a library, and that's also what lets this use the index
+		ids = {
+			row['key']: row['itemID']
+			for row in _select_in(self.cur, f'SELECT itemID, key FROM items WHERE libraryID = {int(library_id)} AND key IN ({{}})', keys)
+		}
+		return [ ids[key] for key in keys ]
+
+	def existing_items(self, item_ids):
+		"""
+		Which of the given itemIDs are still in Zotero.
+		"""
+		return { row['itemID'] for row in _select_in(self.cur, 'SELECT itemID FROM items WHERE itemID IN ({})', list(set(item_ids))) }
+
+	def attachments(self, value_ids):
+		"""
+		Find the attachments already titled with the given valueIDs, returns a
+		dict of valueID to `(item, attachment)`. Anything in the trash is left be.
+		"""
+		return {
+			row['valueID']: (row['parentItemID'], row['itemID'])
+			for row in _select_in(
+				self.cur,
+				'SELECT d.valueID, a.itemID, a.parentItemID FROM itemData d JOIN itemAttachments a ON a.itemID = d.itemID '
+				f'WHERE d.fieldID = {ZOTERO_FIELD_TITLE} AND a.parentItemID IS NOT NULL '
+				'AND a.parentItemID NOT IN (SELECT itemID FROM deletedItems) AND d.valueID IN ({})',
+				list(set(value_ids))
+			)
+		}
+
+	def touch(self, item_ids, date_modified):
+		# Flag them as changed so Zotero picks the edits up and syncs them on
+		self.cur.executemany(
+			'UPDATE items SET dateModified = ?, clientDateModified = ?, synced = 0 WHERE itemID = ?',
+			[ (date_modified, date_modified, item) for item in item_ids ]
+		)
+
+	def trash(self, item_ids):
+		self.cur.executemany('INSERT OR IGNORE INTO deletedItems (itemID) VALUES (?)', [ (item,) for item in item_ids ])
+
+def _load_datasheets(sc):
+	"""
+	Pull what we need to sync for a scraper out of the cache, in one go.
+	"""
+	cache = Datasheet.resolve_connection(Datasheet.__connection__)
+	sheets = cache.table('datasheets') \
+		.where('scraper_id', '=', sc.id) \
+		.where('downloaded', '=', True) \
+		.where_not_null('filename') \
+		.order_by('id') \
+		.get(['id', 'title', 'url', 'filename', 'dl_location'])
+
+	tags = {}
+	for row in cache.select(
+		'SELECT tl.datasheet_id, t.name FROM tag_links tl JOIN datasheet_tags t ON t.id = tl.tag_id '
+		'JOIN datasheets d ON d.id = tl.datasheet_id WHERE d.scraper_id = ? AND t.name != \'\'',
+		[ sc.id ]
+	):
+		tags.setdefault(row['datasheet_id'], []).append(row['name'])
+
+	return (sheets, tags)
+
+def _scraper_collection(tcol, sc):
 	# Try to check if the scraper collection already exists, or create it
 	try:
-		scol = ZCollection \
+		return ZCollection \
 			.where('collectionName', '=', sc.name) \
 			.where('parentCollectionID', '=', tcol.collectionID) \
 			.first_or_fail()
@@ -178,142 +314,235 @@ def sync_scraper(tcol, sc):
 		scol.libraryID = tcol.libraryID
 		scol.key = gen_key()
 		scol.save()
+		return scol
+
+def _fingerprint(ds, tags):
+	return sha256(
+		json.dumps([ ds['title'], ds['url'], ds['filename'], ds['dl_location'], sorted(set(tags)) ]).encode('utf-8')
+	).hexdigest()
+
+def _write_items(zw, scol, rows, tags, values, tag_ids, date_added = None):
+	# Fill in the data, tags and collection for `(datasheet, item, attachment)` rows
+	item_data = []
+	item_tags = []
+	for ds, item, aitm in rows:
+		item_data.append((item, ZOTERO_FIELD_TITLE, values[ds['title']]))
+		if ds['url'] is not None:
+			item_data.append((item, ZOTERO_FIELD_URL, values[ds['url']]))
+		if date_added is not None:
+			item_data.append((item, ZOTERO_FIELD_ACCESSED, values[date_added]))
+		item_data.append((aitm, ZOTERO_FIELD_TITLE, values[ds['filename']]))
+
+		for name in set(tags.get(ds['id'], [])):
+			item_tags.append((item, tag_ids[name], ZOTERO_TAG_AUTOMATIC))
+
+	zw.cur.executemany('INSERT OR REPLACE INTO itemData (itemID, fieldID, valueID) VALUES (?, ?, ?)', item_data)
+	zw.cur.executemany('INSERT OR IGNORE INTO itemTags (itemID, tagID, type) VALUES (?, ?, ?)', item_tags)
+	zw.cur.executemany(
+		'INSERT OR IGNORE INTO collectionItems (collectionID, itemID) VALUES (?, ?)',
+		[ (scol.collectionID, item) for _, item, _ in rows ]
+	)
 
-	for ds in tqdm(Datasheet.where('scraper_id', '=', sc.id).get(), desc = f'Zotero sync: {sc.name}'):
-		tlog(f'  ==> Adding datasheet {ds.title}')
-
-		try:
-			name = ZItemDataValue.where('value', '=', ds.filename).first_or_fail()
-		except:
-			name = ZItemDataValue()
-			name.value = ds.filename
-			name.save()
-
-		try:
-			title = ZItemDataValue.where('value', '=', ds.title).first_or_fail()
-		except:
-			title = ZItemDataValue()
-			title.value = ds.title
-			title.save()
-
-		try:
-			url = ZItemDataValue.where('value', '=', ds.url).first_or_fail()
-		except:
-			url = ZItemDataValue()
-			url.value = ds.url
-			url.save()
-
+def sync_scraper(zw, tcol, sc, sheets, tags, ledger, date_added):
+	"""
+	Bring the Zotero items for a scraper in line with the cache, only the
+	datasheets that changed since they were last synced are looked at. Returns
+	how many items were added and updated.
+	"""
+	fingerprints = { ds['id']: _fingerprint(ds, tags.get(ds['id'], [])) for ds in sheets }
+	changed = [ ds for ds in sheets if (ledger.get(ds['id']) or (None, None, None))[2] != fingerprints[ds['id']] ]
+
+	if len(changed) == 0:
+		inf(f'  => Nothing changed in {sc.name}')
+		return (0, 0)
+
+	log(f'  => Syncing {len(changed)} datasheets from {sc.name}')
+	scol = _scraper_collection(tcol, sc)
+
+	# Anything that was synced before is updated in place, unless it's gone from Zotero since
+	existing = zw.existing_items(ledger.get(ds['id'])[0] for ds in changed if ledger.get(ds['id']) is not None)
+	update = []
+	fresh = []
+	for ds in changed:
+		entry = ledger.get(ds['id'])
+		if entry is not None and entry[0] in existing:
+			update.append((ds, entry[0], entry[1]))
+		else:
+			fresh.append(ds)
+
+	values = zw.value_ids(
+		[ ds['title'] for ds in changed ] + [ ds['filename'] for ds in changed ] +
+		[ ds['url'] for ds in changed if ds['url'] is not None ] + [ date_added ]
+	)
+	tag_ids = zw.tag_ids(name for ds in changed for name in tags.get(ds['id'], []))
+
+	# A datasheet that isn't in the ledger yet may still have an item from an earlier sync, so take that over
+	attached = zw.attachments(values[ds['filename']] for ds in fresh)
+	claimed = ledger.item_ids()
+	missing = []
+	for ds in fresh:
+		found = attached.get(values[ds['filename']])
+		if found is None or found[0] in claimed:
+			# Another datasheet already has that item, so this one gets its own
+			missing.append(ds)
+		else:
+			claimed.add(found[0])
+			update.append((ds, *found))
+
+	if len(update) > 0:
+		# The URL or tags may have been dropped, so clear them out before filling the items back in,
+		# leaving any tags the user put on the items alone
+		zw.cur.executemany(
+			'DELETE FROM itemData WHERE itemID = ? AND fieldID = ?', [ (item, ZOTERO_FIELD_URL) for _, item, _ in update ]
+		)
+		zw.cur.executemany(
+			'DELETE FROM itemTags WHERE itemID = ? AND type = ?', [ (item, ZOTERO_TAG_AUTOMATIC) for _, item, _ in update ]
+		)
+		zw.cur.executemany(
+			'UPDATE itemAttachments SET path = ? WHERE itemID = ?', [ (ds['dl_location'], aitm) for ds, _, aitm in update ]
+		)
+		_write_items(zw, scol, update, tags, values, tag_ids)
+		zw.touch([ item for _, item, aitm in update ] + [ aitm for _, _, aitm in update ], date_added)
+
+	added = []
+	if len(missing) > 0:
+		items = zw.new_items(ZOTERO_ITEM_TYPE, scol.libraryID, len(missing))
+		attachments = zw.new_items(ZOTERO_ATTACHMENT_TYPE, scol.libraryID, len(missing))
+		added = list(zip(missing, items, attachments))
+
+		zw.cur.executemany(
+			'INSERT INTO itemAttachments (itemID, parentItemID, linkMode, path, contentType) VALUES (?, ?, 2, ?, \'application/pdf\')',
+			[ (aitm, item, ds['dl_location']) for ds, item, aitm in added ]
+		)
+		_write_items(zw, scol, added, tags, values, tag_ids, date_added)
+
+	for ds, item, aitm in update + added:
+		ledger.record(ds['id'], item, aitm, fingerprints[ds['id']])
+
+	inf(f'  => Added {len(added)} and updated {len(update)} datasheets from {sc.name}')
+	return (len(added), len(update))
+
+# ==== Backups ==== #
+
+def _db_state(db_file):
+	# The size and modification time of the database and its WAL, if any, change with every commit
+	state = []
+	for f in (db_file, f'{db_file}-wal'):
 		try:
-			da = ZItemDataValue.where('value', '=', date_added).first_or_fail()
-		except:
-			da = ZItemDataValue()
-			da.value = date_added
-			da.save()
-
-		# Check to see the the data values we just created are linked with an item
-		if not ZItemData.where('valueID', '=', name.valueID).exists():
-			# If not, then we can assume that the item doesn't exist, so we create one
-			item = ZItem()
-			item.itemTypeID = 12
-			item.libraryID = scol.libraryID
-			item.key = gen_key()
-			item.save()
-
-			i_title = ZItemData()
-			i_title.itemID = item.itemID
-			i_title.valueID = title.valueID
-			i_title.fieldID = 1
-			i_title.save()
-
-			i_url = ZItemData()
-			i_url.itemID = item.itemID
-			i_url.valueID = url.valueID
-			i_url.fieldID = 13
-			i_url.save()
-
-			i_da = ZItemData()
-			i_da.itemID = item.itemID
-			i_da.valueID = da.valueID
-			i_da.fieldID = 6
-			i_da.save()
-
-			# Attach tags to item
-			for tag in ds.tags().get():
-				if tag.name != '':
-					zt = ZTag.where('name', '=', tag.name).first_or_fail()
-
-					zit = ZItemTag()
-					zit.itemID = item.itemID
-					zit.tagID = zt.tagID
-					zit.type = 0
-					zit.save()
-
-			# Create the attachment item and then the attachment link
-			aitm = ZItem()
-			aitm.itemTypeID = 2
-			aitm.libraryID = scol.libraryID
-			aitm.key = gen_key()
-			aitm.save()
-
-			att_name = ZItemData()
-			att_name.itemID = aitm.itemID
-			att_name.valueID = name.valueID
-			att_name.fieldID = 1
-			att_name.save()
-
-			att = ZItemAttachment()
-			att.itemID = aitm.itemID
-			att.parentItemID = item.itemID
-			att.linkMode = 2
-			att.path = ds.dl_location
-			att.contentType = 'application/pdf'
-			att.save()
-
-			# Finally link it to the collection
-			col = ZCollectionItem()
-			col.collectionID = scol.collectionID
-			col.itemID = item.itemID
-			col.save()
-
-
-
+			st = os.stat(f)
+			state.append([ st.st_size, st.st_mtime_ns ])
+		except FileNotFoundError:
+			state.append(None)
+	return state
+
+def _backups(backup_dir):
+	# Oldest first, the timestamp in the name sorts them
+	return sorted(
+		os.path.join(backup_dir, f) for f in os.listdir(backup_dir)
+		if f.startswith(f'{ZOTERO_BACKUP_NAME}-') and (f.endswith('.sqlite') or f.endswith('.sqlite.gz'))
+	)
 
+def backup_database(args):
+	"""
+	Take a consistent copy of the Zotero database with SQLite's online backup,
+	a few pages at a time so the database isn't locked for the whole copy. This
+	is skipped if nothing has changed since the last backup.
+	"""
+	backup_dir = args.zotero_sync_backup_dir
+	os.makedirs(backup_dir, exist_ok = True)
+
+	state = _db_state(args.zotero_db_loc)
+	last = get_metadata(ZOTERO_BACKUP_STATE)
+	if last is not None and not args.zotero_sync_backup_force:
+		last = json.loads(last)
+		if last['state'] == state and os.path.exists(last['file']):
+			inf(f'  => Zotero db unchanged since the last backup to {last["file"]}, skipping')
+			return
+
+	backup_file = os.path.join(backup_dir, f'{ZOTERO_BACKUP_NAME}-{datetime.now().strftime("%Y%m%d-%H%M%S")}.sqlite')
+	log(f'  => Backing up Zotero db to {backup_file}{".gz" if args.zotero_sync_backup_compress else ""}')
+
+	start_time = datetime.now()
+	src = sqlite3.connect(f'file:{args.zotero_db_loc}?mode=ro', uri = True)
+	dst = sqlite3.connect(f'{backup_file}.part')
+	try:
+		with tqdm(desc = 'backup', unit = 'page', leave = False) as bar:
+			def progress(status, remaining, total):
+				bar.total = total
+				bar.n = total - remaining
+				bar.refresh()
 
+			src.backup(dst, pages = args.zotero_sync_backup_pages, progress = progress, sleep = 0)
+	except:
+		dst.close()
+		os.remove(f'{backup_file}.part')
+		raise
+	finally:
+		src.close()
+	dst.close()
+
+	if args.zotero_sync_backup_compress:
+		with open(f'{backup_file}.part', 'rb') as fin, gzip.open(f'{backup_file}.gz.part', 'wb', compresslevel = 6) as fout:
+			shutil.copyfileobj(fin, fout, 1024 * 1024)
+		os.remove(f'{backup_file}.part')
+		backup_file = f'{backup_file}.gz'
+
+	os.replace(f'{backup_file}.part', backup_file)
+	set_metadata(ZOTERO_BACKUP_STATE, json.dumps({ 'state': state, 'file': backup_file }))
+
+	# Drop the oldest backups past the number we keep
+	backups = _backups(backup_dir)
+	for old in backups[:max(len(backups) - max(args.zotero_sync_backup_keep, 1), 0)]:
+		log(f'  => Removing old backup {old}')
+		os.remove(old)
+
+	log(f'  => Backed up Zotero db in {datetime.now() - start_time}')
 
+# ==== Adapter Methods ==== #
 
 def sync_database(args, dl_dir):
 	inf('Syncing Zotero with Trawler cache')
 
 	if args.zotero_sync_backup:
-		backup_file = os.path.join(args.zotero_sync_backup_dir, 'zotero_backup.sqlite')
+		backup_database(args)
 
-		log(f'  => Backing up Zotero db to {backup_file}')
-		copyfile(args.zotero_db_loc, backup_file)
+	# Get everything we want from the cache before touching Zotero, so it's locked for as little time as possible
+	scrapers = [ (sc, *_load_datasheets(sc)) for sc in Scraper.all() if not sc.meta ]
+	ledger = ZoteroLedger()
+	removed = ledger.removed({ ds['id'] for _, sheets, _ in scrapers for ds in sheets })
+	date_added = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-	# Get the Trawler Zotero collection, or create it otherwise
-	try:
-		tcol = ZCollection.where('collectionName', '=', ZOTERO_TRAWLER_ROOT_COLLECTION).first_or_fail()
-	except:
-		tcol = ZCollection()
-		tcol.collectionName = ZOTERO_TRAWLER_ROOT_COLLECTION
-		tcol.key = gen_key()
-		tcol.libraryID = 1
-		tcol.save()
-
-	# Sync the tags
-	log(f'  => Syncing Trawler tags to Zotero')
-	for tag in tqdm(DatasheetTag.all(), desc = 'Zotero sync: tags'):
-		if tag.name != '':
-			try:
-				zt = ZTag.where('name', '=', tag.name).first_or_fail()
-			except:
-				zt = ZTag()
-				zt.name = tag.name
-				zt.save()
-
-	for sc in Scraper.all():
-		if not sc.meta:
-			sync_scraper(tcol, sc)
+	start_time = datetime.now()
+	with transaction('zotero'):
+		zw = ZoteroWriter(ZItem.resolve_connection(ZItem.__connection__).get_connection().cursor())
+
+		# Get the Trawler Zotero collection, or create it otherwise
+		try:
+			tcol = ZCollection.where('collectionName', '=', ZOTERO_TRAWLER_ROOT_COLLECTION).first_or_fail()
+		except:
+			tcol = ZCollection()
+			tcol.collectionName = ZOTERO_TRAWLER_ROOT_COLLECTION
+			tcol.key = gen_key()
+			tcol.libraryID = 1
+			tcol.save()
+
+		added = 0
+		updated = 0
+		for sc, sheets, tags in scrapers:
+			a, u = sync_scraper(zw, tcol, sc, sheets, tags, ledger, date_added)
+			added += a
+			updated += u
+
+		# Datasheets that have gone from the cache are moved to the Zotero trash, rather than deleted outright
+		if len(removed) > 0:
+			log(f'  => Moving {len(removed)} removed datasheets to the trash')
+			zw.trash(item for ds_id in removed for item in ledger.get(ds_id)[:2] if item is not None)
+
+	# If this doesn't make it, the next sync picks the items up again by their file names
+	ledger.save(removed)
+
+	log(f'Added {added}, updated {updated} and removed {len(removed)} datasheets in Zotero in {datetime.now() - start_time}')
+	return 0
 
 ZOTERO_ACTIONS = {
 	'sync': sync_database
@@ -350,7 +579,39 @@ def parser_init(parser):
 		dest = 'zotero_sync_backup_dir',
 		type = str,
 		default = ZOTERO_BACKUP_DIR,
-		help = 'Specify the location for the Zotero backup file'
+		help = 'Specify the location for the Zotero backup files'
+	)
+
+	zsync.add_argument(
+		'--backup-keep',
+		dest = 'zotero_sync_backup_keep',
+		type = int,
+		default = ZOTERO_BACKUP_KEEP,
+		help = 'How many backups of the Zotero database to keep, the oldest are removed first'
+	)
+
+	zsync.add_argument(
+		'--backup-compress',
+		dest = 'zotero_sync_backup_compress',
+		default = False,
+		action = 'store_true',
+		help = 'Compress the Zotero backup with gzip'
+	)
+
+	zsync.add_argument(
+		'--backup-pages',
+		dest = 'zotero_sync_backup_pages',
+		type = int,
+		default = ZOTERO_BACKUP_PAGES,
+		help = 'How many database pages to copy at a time while backing up, the database is only locked for each step'
+	)
+
+	zsync.add_argument(
+		'--backup-force',
+		dest = 'zotero_sync_backup_force',
+		default = False,
+		action = 'store_true',
+		help = 'Back up the Zotero database even if it hasn\'t changed since the last backup'
 	)
 
 def adapter_main(args, dl_dir):
@@ -0,0 +1,239 @@
+# SPDX-License-Identifier: BSD-3-Clause
+import os
+import copy
+import time
+import shutil
+import tempfile
+import threading
+
+from queue import Queue
+
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions
+from selenium.common.exceptions import TimeoutException
+
+from .common import *
+
+__all__ = (
+	'WebDriverPool',
+	'wait_for', 'element_present', 'result_count_stable', 'network_idle',
+	'wait_stats', 'log_wait_stats',
+)
+
+# How often the wait conditions are checked, in seconds
+WAIT_POLL_INTERVAL = 0.1
+
+# How long each kind of wait took, shared across all the browsers
+_wait_times = {}
+_wait_lock = threading.Lock()
+
+# Lock files the browsers leave in a profile that is in use
+_PROFILE_LOCKS = ('Singleton*', 'lock', '.parentlock', 'parent.lock')
+
+def _profile_options(driver_options, profile_dir):
+	# Point a copy of the driver options at another profile directory
+	opts = copy.deepcopy(driver_options)
+
+	if any(map(lambda a: a.startswith('user-data-dir='), opts.arguments)):
+		opts._arguments = [ a for a in opts.arguments if not a.startswith('user-data-dir=') ]
+		opts.add_argument(f'user-data-dir={profile_dir}')
+
+	if getattr(opts, 'profile', None) is not None:
+		from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
+		opts.profile = FirefoxProfile(profile_dir)
+
+	return opts
+
+class WebDriverPool:
+	"""
+	A set of browser instances that can be handed work in parallel. When there
+	is more than one, each gets its own copy of the WebDriver profile so they
+	don't fight over it. The browsers are started on first use and kept until
+	the pool is closed.
+
+	Work is run on the pool's threads, and `done` is called from them, so
+	anything touching the database should be handed back to the caller's
+	thread, as `pipeline.Pipeline` does.
+	"""
+
+	def __init__(self, driver, driver_options, args, size = None):
+		self.driver = driver
+		self.driver_options = driver_options
+		self.args = args
+		self.size = max(size if size is not None else args.browsers, 1)
+		self._work = Queue()
+		self._workers = []
+		self._profiles = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		for _ in self._workers:
+			self._work.put(None)
+		for t in self._workers:
+			t.join()
+		self._workers = []
+
+		for profile in self._profiles:
+			shutil.rmtree(profile, ignore_errors = True)
+		self._profiles = []
+
+	def _options(self):
+		if self.size == 1:
+			return self.driver_options
+
+		tmp = tempfile.mkdtemp(prefix = 'trawler-wd-')
+		self._profiles.append(tmp)
+		# NOTE: copytree() only grew dirs_exist_ok in 3.8, so copy into a directory that doesn't exist yet
+		profile = os.path.join(tmp, 'profile')
+		shutil.copytree(
+			self.args.profile_directory, profile, symlinks = True,
+			ignore = shutil.ignore_patterns(*_PROFILE_LOCKS)
+		)
+		return _profile_options(self.driver_options, profile)
+
+	def _spawn(self):
+		while len(self._workers) < self.size:
+			t = threading.Thread(target = self._worker, args = (self._options(),), daemon = True)
+			t.start()
+			self._workers.append(t)
+
+	def _worker(self, opts):
+		wd = None
+		try:
+			while True:
+				job = self._work.get()
+				if job is None:
+					break
+
+				fn, item, attempt, done = job
+				try:
+					if wd is None:
+						wd = self.driver(options = opts)
+					result = fn(wd, item)
+				except Exception as e:
+					# Whatever state the browser is in now can't be trusted, so start over
+					if wd is not None:
+						try:
+							wd.quit()
+						except Exception:
+							pass
+						wd = None
+
+					if attempt + 1 < self.args.retry:
+						twrn(f'  => Browser failed on {item}, retrying')
+						self._work.put((fn, item, attempt + 1, done))
+					else:
+						done(None, e)
+				else:
+					done(result, None)
+		finally:
+			if wd is not None:
+				wd.quit()
+
+	def submit(self, fn, item, done):
+		"""
+		Queue up `fn(driver, item)` to run on the pool, `done(result, error)` is
+		called from the pool's thread once it has finished or given up. Items that
+		fail are retried on a fresh browser up to `--retry` times.
+		"""
+		self._spawn()
+		self._work.put((fn, item, 0, done))
+
+
+# ==== Waiting ==== #
+
+def element_present(by, selector):
+	"""
+	Ready once the element matching `selector` is on the page.
+	"""
+	return expected_conditions.presence_of_element_located((by, selector))
+
+class result_count_stable:
+	"""
+	Ready once there are at least `min_count` elements matching `selector`, and
+	that number hasn't changed for `settle` seconds.
+	"""
+
+	def __init__(self, by, selector, min_count = 1, settle = 0.5):
+		self.by = by
+		self.selector = selector
+		self.min_count = min_count
+		self.settle = settle
+		self._count = None
+		self._since = None
+
+	def __call__(self, driver):
+		count = len(driver.find_elements(self.by, self.selector))
+		now = time.monotonic()
+		if count != self._count:
+			self._count = count
+			self._since = now
+			return False
+
+		return count >= self.min_count and now - self._since >= self.settle
+
+class network_idle:
+	"""
+	Ready once the page has loaded and it hasn't started fetching anything new
+	for `idle` seconds.
+	"""
+
+	def __init__(self, idle = 0.5):
+		self.idle = idle
+		self._requests = None
+		self._since = None
+
+	def __call__(self, driver):
+		state, requests = driver.execute_script(
+			'return [document.readyState, performance.getEntriesByType("resource").length]'
+		)
+		now = time.monotonic()
+		if state != 'complete' or requests != self._requests:
+			self._requests = requests
+			self._since = now
+			return False
+
+		return now - self._since >= self.idle
+
+def wait_for(driver, condition, timeout, name = None):
+	"""
+	Wait up to `timeout` seconds for `condition` to be met on the page, returns
+	whether it was. How long it took is recorded under `name`, for `wait_stats`.
+	"""
+	start = time.monotonic()
+	try:
+		WebDriverWait(driver, timeout, poll_frequency = WAIT_POLL_INTERVAL).until(condition)
+		ready = True
+	except TimeoutException:
+		ready = False
+
+	if name is not None:
+		elapsed = time.monotonic() - start
+		with _wait_lock:
+			_wait_times.setdefault(name, []).append((elapsed, ready))
+
+	return ready
+
+def wait_stats():
+	"""
+	Summarize the recorded waits, returns a dict of name to the number of
+	waits, how many timed out, and the mean and max time they took.
+	"""
+	with _wait_lock:
+		return {
+			name: {
+				'count': len(times),
+				'timeouts': len([ t for t in times if not t[1] ]),
+				'mean': sum(map(lambda t: t[0], times)) / len(times),
+				'max': max(map(lambda t: t[0], times)),
+			} for name, times in _wait_times.items()
+		}
+
+def log_wait_stats():
+	for name, stats in sorted(wait_stats().items()):
+		inf(f'Waited on {name} {stats["count"]} times, mean {stats["mean"]:.2f}s, max {stats["max"]:.2f}s, {stats["timeouts"]} timed out')
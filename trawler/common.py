@@ -2,12 +2,12 @@
 import sys
 import os
 import collections.abc
-from tqdm import tqdm
+from argparse import ArgumentTypeError
 
 __all__ = (
 	'log', 'err', 'wrn', 'inf', 'dbg',
 	'tlog', 'terr', 'twrn', 'tinf', 'tdbg',
-	'fixup_title',
+	'fixup_title', 'fmt_size', 'parse_rate',
 
 	'EXECUTABLE_EXTS', 'ARCHIVE_EXTS'
 )
@@ -36,20 +36,25 @@ def inf(str, end = '\n', file = sys.stdout):
 def dbg(str, end = '\n', file = sys.stdout):
 	print(f'\x1B[34m[~]\x1B[0m {str}', end = end, file = file)
 
+def _twrite(str, end, file):
+	# tqdm is only pulled in once something actually wants to log around a progress bar
+	from tqdm import tqdm
+	tqdm.write(str, end = end, file = file)
+
 def tlog(str, end = '\n', file = sys.stdout):
-	tqdm.write(f'\x1B[35m[*]\x1B[0m {str}', end = end, file = file)
+	_twrite(f'\x1B[35m[*]\x1B[0m {str}', end = end, file = file)
 
 def terr(str, end = '\n', file = sys.stderr):
-	tqdm.write(f'\x1B[31m[!]\x1B[0m {str}', end = end, file = file)
+	_twrite(f'\x1B[31m[!]\x1B[0m {str}', end = end, file = file)
 
 def twrn(str, end = '\n', file = sys.stderr):
-	tqdm.write(f'\x1B[33m[~]\x1B[0m {str}', end = end, file = file)
+	_twrite(f'\x1B[33m[~]\x1B[0m {str}', end = end, file = file)
 
 def tinf(str, end = '\n', file = sys.stdout):
-	tqdm.write(f'\x1B[36m[~]\x1B[0m {str}', end = end, file = file)
+	_twrite(f'\x1B[36m[~]\x1B[0m {str}', end = end, file = file)
 
 def tdbg(str, end = '\n', file = sys.stdout):
-	tqdm.write(f'\x1B[34m[~]\x1B[0m {str}', end = end, file = file)
+	_twrite(f'\x1B[34m[~]\x1B[0m {str}', end = end, file = file)
 
 def recusive_zip(d, u):
 	for k, v in u.items():
@@ -64,3 +69,18 @@ def fixup_title(s):
 		return f'{s}{" "*(18 - len(s))}'
 	else:
 		return f'{s[:15]}...'
+
+def fmt_size(n):
+	for unit in ('B', 'KiB', 'MiB', 'GiB'):
+		if n < 1024:
+			return f'{n:.1f} {unit}' if unit != 'B' else f'{n} {unit}'
+		n /= 1024
+	return f'{n:.1f} TiB'
+
+def parse_rate(s):
+	try:
+		host, limit = s.split('=', 1)
+		rate, _, burst = limit.partition(':')
+		return (host, float(rate), int(burst) if burst != '' else 1)
+	except ValueError:
+		raise ArgumentTypeError(f'Invalid rate \'{s}\', expected host=requests_per_second[:burst]')
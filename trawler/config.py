@@ -21,7 +21,7 @@ class WebdriverBackend(Enum):
 # ==== Various constants ==== #
 TRAWLER_NAME = 'trawler'
 TRAWLER_VERSION = 'v0.2'
-TRAWLER_SCHEMA_VERSION = 1
+TRAWLER_SCHEMA_VERSION = 8
 
 # ==== Directories ==== #
 XDG_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache') if 'XDG_CACHE_HOME' not in os.environ else os.environ['XDG_CACHE_HOME']
@@ -39,6 +39,15 @@ DEFAULT_OUTPUT_DIR = TRAWLER_DL_DIR
 DEFAULT_TIMEOUT = 120
 DEFAULT_RETRY_COUNT = 3
 DEFAULT_DOWNLOAD_DELAY = 3
+DEFAULT_BACKOFF = 2
+MAX_BACKOFF = 300
+DEFAULT_DOWNLOAD_JOBS = 4
+DEFAULT_MAX_PER_HOST = 2
+DEFAULT_POOL_SIZE = 4
+DEFAULT_REFRESH_AGE = None
+DEFAULT_BLOB_STORE = None
+DEFAULT_PIPELINE_QUEUE = 100
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 DEFAULT_PROFILE_DIRECTORY = os.path.join(TRAWLER_CACHE, '.webdriver_profile')
 DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:59.0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.9999.9999 Safari/537.36'
 
@@ -46,6 +55,12 @@ DEFAULT_DATABASE = os.path.join(TRAWLER_CACHE, 'datasheets.db')
 DEFAULT_WEBDRIVER = WebdriverBackend.Chrome
 DEFAULT_WD_HEADLESS = False
 DEFAULT_WD_HEADLESS_RES = (1920, 1080)
+DEFAULT_WD_POOL_SIZE = 1
+
+# ==== Database Tuning ==== #
+DB_BATCH_SIZE = 1000
+DB_CACHE_SIZE_KIB = 64 * 1024
+DEFAULT_DB_BUSY_TIMEOUT = 30
 
 # ==== Zotero Stuff ==== #
 ZOTERO_ROOT = os.path.join(os.path.expanduser('~'), 'Zotero')
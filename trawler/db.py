@@ -2,6 +2,9 @@
 from orator import Model, orm
 from orator.migrations import Migrator, Migration, DatabaseMigrationRepository
 
+from datetime import datetime
+from contextlib import contextmanager
+
 from . import config
 from .common import *
 
@@ -23,7 +26,9 @@ class Datasheet(Model):
 	__fillable__ = [
 		'scraper_id', 'title', 'url', 'filename',
 		'dl_location', 'version', 'found', 'last_seen',
-		'downloaded', 'src'
+		'downloaded', 'src', 'etag', 'last_modified',
+		'content_length', 'sha256', 'dl_error',
+		'dl_error_permanent'
 	]
 	__connection__ = 'trawler_cache'
 
@@ -33,15 +38,26 @@ class Datasheet(Model):
 	def add_tag(self, tag):
 		if not self.has_tag(tag):
 			self.tags().attach(tag)
+			refresh_search_index(self.get_connection().get_connection().cursor())
 
 	def remove_tag(self, tag):
 		if self.has_tag(tag):
 			self.tags().detach(tag)
+			refresh_search_index(self.get_connection().get_connection().cursor())
 
 	@orm.belongs_to_many('tag_links', 'datasheet_id', 'tag_id')
 	def tags(self):
 		return DatasheetTag
 
+class SourceDigest(Model):
+	__fillable__ = ['scraper_id', 'key', 'digest', 'datasheet_id']
+	__connection__ = 'trawler_cache'
+
+class ZoteroSyncEntry(Model):
+	__fillable__ = ['datasheet_id', 'item_id', 'attachment_id', 'fingerprint', 'synced_at']
+	__connection__ = 'trawler_cache'
+	__table__ = 'zotero_sync'
+
 class Scraper(Model):
 	__fillable__ = ['name', 'last_run']
 	__connection__ = 'trawler_cache'
@@ -50,8 +66,416 @@ class Scraper(Model):
 	def datasheets(self):
 		return Datasheet
 
+# ==== Connection Handling ==== #
+
+def tune_connection(dbm, name):
+	"""
+	Switch the cache database over to WAL so readers and a writer in other
+	processes don't lock each other out, and relax the fsync on each commit.
+	"""
+	conn = dbm.connection(name).get_connection()
+	conn.execute('PRAGMA journal_mode = WAL')
+	conn.execute('PRAGMA synchronous = NORMAL')
+	conn.execute(f'PRAGMA cache_size = -{config.DB_CACHE_SIZE_KIB}')
+	conn.execute('PRAGMA temp_store = MEMORY')
+
+@contextmanager
+def transaction(connection = 'trawler_cache'):
+	"""
+	Group everything done inside of the block into one transaction, for use
+	around a page or batch worth of model saves. These can be nested.
+	"""
+	with Model.resolve_connection(connection).transaction() as conn:
+		yield conn
+
+# ==== Bulk Operations ==== #
+
+def _chunks(items, size):
+	items = list(items)
+	for i in range(0, len(items), size):
+		yield items[i:i + size]
+
+def _sql_value(v):
+	if isinstance(v, datetime):
+		return v.isoformat(' ')
+	return v
+
+class DatasheetBatch:
+	"""
+	Batched upsert of datasheets for a single scraper.
+
+	The existing title -> id map for the scraper is loaded once up front, and
+	records are then written out `batch_size` at a time with `executemany`
+	inside of a single transaction. New rows get every field they were given,
+	existing rows only get the fields listed in `update`. With `replace_tags`
+	the tags given for a datasheet over the life of the batch replace the ones
+	it had, rather than being added to them.
+	"""
+
+	def __init__(self, scraper_id, update = ('last_seen',), batch_size = config.DB_BATCH_SIZE, replace_tags = False):
+		self.scraper_id = scraper_id
+		self.update = tuple(update)
+		self.replace_tags = replace_tags
+		self.batch_size = batch_size
+		self.db = Datasheet.resolve_connection(Datasheet.__connection__)
+
+		self.ids = {}
+		for row in self.db.table('datasheets').where('scraper_id', '=', scraper_id).get(['id', 'title']):
+			self.ids[row['title']] = row['id']
+
+		self.tags = TagRegistry(scraper_id, self.db)
+		self.links = {}
+		for row in self.db.select(
+			'SELECT datasheet_id, tag_id FROM tag_links '
+			'INNER JOIN datasheet_tags ON datasheet_tags.id = tag_links.tag_id '
+			'WHERE datasheet_tags.scraper_id = ?', [scraper_id]
+		):
+			self.links.setdefault(row['datasheet_id'], set()).add(row['tag_id'])
+
+		self._inserts = {}
+		self._updates = {}
+		self._tags = []
+		self._retag = set()
+		# The tags each datasheet has been given so far, when they are being replaced
+		self._wanted = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.flush()
+
+	def __len__(self):
+		return len(self._inserts) + len(self._updates)
+
+	def add(self, title, tags = (), **fields):
+		# Datasheets are keyed on their title, so without one there's nothing to file it under
+		if title is None or title.strip() == '':
+			wrn(f'  => Skipping a datasheet with no title ({fields.get("url") or fields.get("src")})')
+			return
+
+		now = datetime.now()
+		fields.setdefault('last_seen', now)
+
+		if title in self.ids:
+			rec = self._updates.setdefault(self.ids[title], {})
+			rec.update({ k: v for k, v in fields.items() if k in self.update })
+		elif title in self._inserts:
+			# Seen twice in the same batch, treat it like the update it would have been
+			self._inserts[title].update({ k: v for k, v in fields.items() if k in self.update })
+		else:
+			fields.setdefault('found', now)
+			self._inserts[title] = dict(fields, title = title, scraper_id = self.scraper_id)
+
+		for tag in tags:
+			if tag != '':
+				self._tags.append((title, tag))
+		if self.replace_tags:
+			self._retag.add(title)
+
+		if len(self) >= self.batch_size:
+			self.flush()
+
+	def flush(self):
+		if len(self) == 0 and len(self._tags) == 0 and len(self._retag) == 0:
+			return
+
+		now = _sql_value(datetime.now())
+		with transaction(Datasheet.__connection__):
+			cur = self.db.get_connection().cursor()
+
+			if len(self._inserts) > 0:
+				cols = sorted(set(c for rec in self._inserts.values() for c in rec))
+				# NOTE: Another process may have added some of these since we loaded the ids,
+				# those are left alone here and picked up by the update below instead.
+				cur.executemany(
+					f'INSERT OR IGNORE INTO datasheets ({", ".join(cols)}, created_at, updated_at) '
+					f'VALUES ({", ".join("?" * (len(cols) + 2))})',
+					[
+						[_sql_value(rec.get(c)) for c in cols] + [now, now]
+							for rec in self._inserts.values()
+					]
+				)
+
+				# Pick up the ids of what we just inserted
+				for titles in _chunks(self._inserts.keys(), 500):
+					cur.execute(
+						f'SELECT id, title FROM datasheets WHERE scraper_id = ? AND title IN ({", ".join("?" * len(titles))})',
+						[self.scraper_id] + titles
+					)
+					for row in cur.fetchall():
+						self.ids[row['title']] = row['id']
+
+				for title, rec in self._inserts.items():
+					self._updates[self.ids[title]] = { k: v for k, v in rec.items() if k in self.update }
+
+			for cols in set(tuple(sorted(rec)) for rec in self._updates.values()):
+				if len(cols) == 0:
+					continue
+
+				cur.executemany(
+					f'UPDATE datasheets SET {", ".join(f"{c} = ?" for c in cols)}, updated_at = ? WHERE id = ?',
+					[
+						[_sql_value(rec[c]) for c in cols] + [now, id]
+							for id, rec in self._updates.items() if tuple(sorted(rec)) == cols
+					]
+				)
+
+			self._link_tags(cur, now)
+			refresh_search_index(cur)
+
+		self._inserts = {}
+		self._updates = {}
+		self._tags = []
+		self._retag = set()
+
+	def _link_tags(self, cur, now):
+		if len(self._tags) == 0 and len(self._retag) == 0:
+			return
+
+		self.tags.ensure(cur, (name for _, name in self._tags), now)
+
+		links = set()
+		for title, name in self._tags:
+			ds_id, tag_id = self.ids[title], self.tags[name]
+			if tag_id not in self.links.get(ds_id, ()):
+				links.add((ds_id, tag_id))
+			if self.replace_tags:
+				self._wanted.setdefault(ds_id, set()).add(tag_id)
+
+		cur.executemany(
+			'INSERT OR IGNORE INTO tag_links (datasheet_id, tag_id, created_at, updated_at) VALUES (?, ?, ?, ?)',
+			[(ds_id, tag_id, now, now) for ds_id, tag_id in links]
+		)
+		for ds_id, tag_id in links:
+			self.links.setdefault(ds_id, set()).add(tag_id)
+
+		stale = set()
+		for title in self._retag:
+			ds_id = self.ids[title]
+			stale |= { (ds_id, tag_id) for tag_id in self.links.get(ds_id, set()) - self._wanted.get(ds_id, set()) }
+
+		cur.executemany('DELETE FROM tag_links WHERE datasheet_id = ? AND tag_id = ?', list(stale))
+		for ds_id, tag_id in stale:
+			self.links[ds_id].discard(tag_id)
+
+class TagRegistry:
+	"""
+	The name -> id map of all of the tags for a single scraper, loaded once.
+	"""
+
+	def __init__(self, scraper_id, db = None):
+		self.scraper_id = scraper_id
+		self.db = db if db is not None else DatasheetTag.resolve_connection(DatasheetTag.__connection__)
+
+		self.ids = {}
+		for row in self.db.table('datasheet_tags').where('scraper_id', '=', scraper_id).get(['id', 'name']):
+			self.ids.setdefault(row['name'], row['id'])
+
+	def __getitem__(self, name):
+		return self.ids[name]
+
+	def __contains__(self, name):
+		return name in self.ids
+
+	def ensure(self, cur, names, now):
+		missing = set(n for n in names if n not in self.ids)
+		if len(missing) == 0:
+			return
+
+		cur.executemany(
+			'INSERT OR IGNORE INTO datasheet_tags (scraper_id, name, created_at, updated_at) VALUES (?, ?, ?, ?)',
+			[(self.scraper_id, name, now, now) for name in missing]
+		)
+
+		for names in _chunks(missing, 500):
+			cur.execute(
+				f'SELECT id, name FROM datasheet_tags WHERE scraper_id = ? AND name IN ({", ".join("?" * len(names))})',
+				[self.scraper_id] + names
+			)
+			for row in cur.fetchall():
+				self.ids.setdefault(row['name'], row['id'])
+
+class SourceDigests:
+	"""
+	Per-document digests of what a scraper last saw at its source, keyed by
+	whatever the source uses to identify a document, so that unchanged documents
+	can be skipped and ones that have gone away can be found.
+	"""
+
+	def __init__(self, scraper_id):
+		self.scraper_id = scraper_id
+		self.db = SourceDigest.resolve_connection(SourceDigest.__connection__)
+
+		self.digests = {}
+		for row in self.db.table('source_digests').where('scraper_id', '=', scraper_id).get(['key', 'digest', 'datasheet_id']):
+			self.digests[row['key']] = (row['digest'], row['datasheet_id'])
+
+		self.seen = set()
+		self._changed = {}
+
+	def check(self, key, digest):
+		"""
+		Note that `key` is still present, returns True if it is new or has changed.
+		"""
+		self.seen.add(key)
+		known = self.digests.get(key)
+		return known is None or known[0] != digest
+
+	def record(self, key, digest, datasheet_id):
+		self._changed[key] = (digest, datasheet_id)
+
+	def removed(self):
+		return [key for key in self.digests if key not in self.seen]
+
+	def save(self, prune = False):
+		"""
+		Write out the recorded digests, and if `prune` is set drop the datasheets
+		for anything that we didn't see this time around.
+		"""
+		gone = self.removed() if prune else []
+		# Anything no longer pointed at by a document we still have is stale
+		stale = { self.digests[key][1] for key in gone }
+		stale |= { self.digests[key][1] for key in self._changed if key in self.digests }
+		for key in gone:
+			del self.digests[key]
+		self.digests.update(self._changed)
+		stale -= { ds_id for _, ds_id in self.digests.values() }
+		stale.discard(None)
+
+		now = _sql_value(datetime.now())
+		with transaction(SourceDigest.__connection__):
+			cur = self.db.get_connection().cursor()
+			cur.executemany(
+				'INSERT OR REPLACE INTO source_digests (scraper_id, key, digest, datasheet_id, created_at, updated_at) '
+				'VALUES (?, ?, ?, ?, ?, ?)',
+				[(self.scraper_id, key, digest, ds_id, now, now) for key, (digest, ds_id) in self._changed.items()]
+			)
+
+			for chunk in _chunks(gone, 500):
+				cur.execute(
+					f'DELETE FROM source_digests WHERE scraper_id = ? AND key IN ({", ".join("?" * len(chunk))})',
+					[self.scraper_id] + chunk
+				)
+
+			# NOTE: Orator turns foreign keys on, so the tag links would cascade anyway, this just
+			# doesn't depend on that pragma being set for whoever opened the cache
+			for chunk in _chunks(list(stale), 500):
+				marks = ", ".join("?" * len(chunk))
+				cur.execute(f'DELETE FROM tag_links WHERE datasheet_id IN ({marks})', chunk)
+				cur.execute(f'DELETE FROM datasheets WHERE id IN ({marks})', chunk)
+			refresh_search_index(cur)
+
+		self._changed = {}
+		return len(stale)
+
+class ZoteroLedger:
+	"""
+	What has been synced to Zotero, which items each datasheet ended up as and a
+	fingerprint of how it looked at the time, so that a sync only has to touch
+	the datasheets that were added, changed or removed since the last one.
+	"""
+
+	def __init__(self):
+		self.db = ZoteroSyncEntry.resolve_connection(ZoteroSyncEntry.__connection__)
+
+		self.entries = {}
+		for row in self.db.table('zotero_sync').get(['datasheet_id', 'item_id', 'attachment_id', 'fingerprint']):
+			self.entries[row['datasheet_id']] = (row['item_id'], row['attachment_id'], row['fingerprint'])
+
+		self._changed = {}
+
+	def get(self, datasheet_id):
+		"""
+		Returns `(item_id, attachment_id, fingerprint)` for a synced datasheet, or None.
+		"""
+		return self.entries.get(datasheet_id)
+
+	def item_ids(self):
+		return { entry[0] for entry in self.entries.values() }
+
+	def record(self, datasheet_id, item_id, attachment_id, fingerprint):
+		self._changed[datasheet_id] = (item_id, attachment_id, fingerprint)
+
+	def removed(self, datasheet_ids):
+		"""
+		The datasheets that were synced but are no longer in `datasheet_ids`.
+		"""
+		return [ ds_id for ds_id in self.entries if ds_id not in datasheet_ids ]
+
+	def save(self, removed = ()):
+		"""
+		Write out the recorded entries, and forget about the `removed` datasheets.
+		"""
+		now = _sql_value(datetime.now())
+		with transaction(ZoteroSyncEntry.__connection__):
+			cur = self.db.get_connection().cursor()
+			cur.executemany(
+				'INSERT OR REPLACE INTO zotero_sync (datasheet_id, item_id, attachment_id, fingerprint, synced_at, created_at, updated_at) '
+				'VALUES (?, ?, ?, ?, ?, ?, ?)',
+				[(ds_id, item, aitm, fp, now, now, now) for ds_id, (item, aitm, fp) in self._changed.items()]
+			)
+
+			for chunk in _chunks(list(removed), 500):
+				cur.execute(f'DELETE FROM zotero_sync WHERE datasheet_id IN ({", ".join("?" * len(chunk))})', chunk)
+
+		for ds_id in removed:
+			self.entries.pop(ds_id, None)
+		self.entries.update(self._changed)
+		self._changed = {}
+
+def get_metadata(name, default = None):
+	try:
+		return CacheMetadata.where('name', '=', name).first_or_fail().value
+	except:
+		return default
+
+def set_metadata(name, value):
+	try:
+		md = CacheMetadata.where('name', '=', name).first_or_fail()
+	except:
+		md = CacheMetadata()
+		md.name = name
+
+	md.value = value
+	md.save()
+
 # ==== Migration ==== #
 
+def _dedupe_rows(db, table, columns, prefer = None, refs = ()):
+	"""
+	Collapse rows of `table` that share the same `columns` down to a single row,
+	re-pointing the (table, column) pairs in `refs` at the one that is kept.
+	"""
+	cols = ', '.join(columns)
+	keep = f'COALESCE(MIN(CASE WHEN {prefer} THEN id END), MIN(id))' if prefer is not None else 'MIN(id)'
+
+	db.statement('DROP TABLE IF EXISTS temp.dedupe_map')
+	db.statement('CREATE TEMP TABLE dedupe_map (old_id INTEGER PRIMARY KEY, keep_id INTEGER NOT NULL)')
+	db.statement(
+		f'INSERT INTO dedupe_map (old_id, keep_id) '
+		f'SELECT t.id, k.keep_id FROM {table} t INNER JOIN ('
+		f'SELECT {cols}, {keep} AS keep_id FROM {table} GROUP BY {cols} HAVING COUNT(*) > 1'
+		f') k ON {" AND ".join(f"t.{c} = k.{c}" for c in columns)} '
+		f'WHERE t.id != k.keep_id'
+	)
+
+	dupes = db.select('SELECT COUNT(*) AS dupes FROM dedupe_map')[0]['dupes']
+	if dupes > 0:
+		wrn(f'  => Removing {dupes} duplicate rows from {table}')
+
+		for ref_table, ref_col in refs:
+			db.statement(
+				f'UPDATE {ref_table} SET {ref_col} = (SELECT keep_id FROM dedupe_map WHERE old_id = {ref_table}.{ref_col}) '
+				f'WHERE {ref_col} IN (SELECT old_id FROM dedupe_map)'
+			)
+
+		db.statement(f'DELETE FROM {table} WHERE id IN (SELECT old_id FROM dedupe_map)')
+
+	db.statement('DROP TABLE temp.dedupe_map')
+
+
 class CreateDatasheetTable(Migration):
 	def up(self):
 		with self.schema.create('datasheets') as table:
@@ -65,13 +489,43 @@ class CreateDatasheetTable(Migration):
 			table.string('dl_location').nullable()
 			table.string('version').nullable()
 			table.boolean('downloaded').nullable()
+			table.string('etag').nullable()
+			table.string('last_modified').nullable()
+			table.big_integer('content_length').nullable()
+			table.string('sha256', 64).nullable()
+			table.string('dl_error').nullable()
+			table.boolean('dl_error_permanent').nullable()
 			table.datetime('last_seen').nullable()
 			table.datetime('found')
 			table.timestamps()
+			table.unique(['scraper_id', 'title'])
 
 	def update(self, from_version):
+		if from_version < 5:
+			_dedupe_rows(
+				self.db, 'datasheets', ('scraper_id', 'title'),
+				prefer = 'downloaded', refs = (('tag_links', 'datasheet_id'),)
+			)
+
 		with self.schema.table('datasheets') as table:
-			pass
+			# HTTP validators for conditional re-downloads
+			if from_version < 2 and not self.schema.has_column('datasheets', 'etag'):
+				table.string('etag').nullable()
+				table.string('last_modified').nullable()
+				table.big_integer('content_length').nullable()
+
+			# Content digest for the blob store
+			if from_version < 3 and not self.schema.has_column('datasheets', 'sha256'):
+				table.string('sha256', 64).nullable()
+
+			# Why the last download failed, so dead links can be skipped
+			if from_version < 4 and not self.schema.has_column('datasheets', 'dl_error'):
+				table.string('dl_error').nullable()
+				table.boolean('dl_error_permanent').nullable()
+
+			# Indexes for the hot lookups
+			if from_version < 5:
+				table.unique(['scraper_id', 'title'])
 
 	def down(self):
 		self.schema.drop('datasheets')
@@ -88,7 +542,7 @@ class CreateScraperTable(Migration):
 	def update(self, from_version):
 		with self.schema.table('scrapers') as table:
 			# All the fields added in v0.2
-			if from_version < 1:
+			if from_version < 1 and not self.schema.has_column('scrapers', 'meta'):
 				table.boolean('meta').nullable()
 
 	def down(self):
@@ -102,10 +556,19 @@ class CreateDatasheetTagTable(Migration):
 			table.foreign('scraper_id').references('id').on('scrapers').on_delete('cascade')
 			table.string('name')
 			table.timestamps()
+			table.unique(['scraper_id', 'name'])
 
 	def update(self, from_version):
+		if from_version < 5:
+			_dedupe_rows(
+				self.db, 'datasheet_tags', ('scraper_id', 'name'),
+				refs = (('tag_links', 'tag_id'),)
+			)
+
 		with self.schema.table('datasheet_tags') as table:
-			pass
+			# Indexes for the hot lookups
+			if from_version < 5:
+				table.unique(['scraper_id', 'name'])
 
 	def down(self):
 		self.schema.drop('datasheet_tags')
@@ -119,10 +582,18 @@ class CreateTagLinkTable(Migration):
 			table.integer('datasheet_id').unsigned()
 			table.foreign('datasheet_id').references('id').on('datasheets').on_delete('cascade')
 			table.timestamps()
+			table.unique(['datasheet_id', 'tag_id'])
+			table.index('tag_id')
 
 	def update(self, from_version):
+		if from_version < 5:
+			_dedupe_rows(self.db, 'tag_links', ('datasheet_id', 'tag_id'))
+
 		with self.schema.table('tag_links') as table:
-			pass
+			# Indexes for the hot lookups
+			if from_version < 5:
+				table.unique(['datasheet_id', 'tag_id'])
+				table.index('tag_id')
 
 	def down(self):
 		self.schema.drop('tag_links')
@@ -142,6 +613,127 @@ class CreateCacheMetadataTable(Migration):
 	def down(self):
 		self.schema.drop('cache_metadata')
 
+class CreateSourceDigestTable(Migration):
+	def up(self):
+		with self.schema.create('source_digests') as table:
+			table.increments('id').unique()
+			table.integer('scraper_id').unsigned()
+			table.foreign('scraper_id').references('id').on('scrapers').on_delete('cascade')
+			table.string('key')
+			table.string('digest', 64)
+			table.integer('datasheet_id').unsigned().nullable()
+			table.foreign('datasheet_id').references('id').on('datasheets').on_delete('set null')
+			table.timestamps()
+			table.unique(['scraper_id', 'key'])
+
+	def update(self, from_version):
+		# Added in schema v6
+		if not self.schema.has_table('source_digests'):
+			self.up()
+
+	def down(self):
+		self.schema.drop('source_digests')
+
+class CreateZoteroSyncTable(Migration):
+	def up(self):
+		# NOTE: No foreign key on the datasheet, the entry has to outlive it so it can be removed from Zotero
+		with self.schema.create('zotero_sync') as table:
+			table.increments('id').unique()
+			table.integer('datasheet_id').unsigned().unique()
+			table.integer('item_id').unsigned()
+			table.integer('attachment_id').unsigned().nullable()
+			table.string('fingerprint', 64).nullable()
+			table.datetime('synced_at').nullable()
+			table.timestamps()
+
+	def update(self, from_version):
+		# Added in schema v7
+		if not self.schema.has_table('zotero_sync'):
+			self.up()
+
+	def down(self):
+		self.schema.drop('zotero_sync')
+
+# The tags of a datasheet, as one bit of text for the search index
+_SEARCH_TAGS = (
+	"COALESCE((SELECT group_concat(t.name, ' ') FROM tag_links tl "
+	"INNER JOIN datasheet_tags t ON t.id = tl.tag_id WHERE tl.datasheet_id = {}), '')"
+)
+
+# Triggers that keep the search index in step with the datasheets. Rewriting an
+# index row for every tag link is slow, so those only mark the datasheet, and
+# whatever changed the links calls `refresh_search_index` before it commits.
+_SEARCH_TRIGGERS = {
+	'datasheet_search_insert': (
+		'AFTER INSERT ON datasheets BEGIN '
+		'INSERT INTO datasheet_search (rowid, title, tags, vendor, filename) VALUES '
+		'(new.id, new.title, \'\', (SELECT name FROM scrapers WHERE id = new.scraper_id), new.filename); END'
+	),
+	'datasheet_search_update': (
+		'AFTER UPDATE OF title, filename, scraper_id ON datasheets '
+		'WHEN old.title IS NOT new.title OR old.filename IS NOT new.filename OR old.scraper_id IS NOT new.scraper_id BEGIN '
+		'UPDATE datasheet_search SET title = new.title, filename = new.filename, '
+		'vendor = (SELECT name FROM scrapers WHERE id = new.scraper_id) WHERE rowid = new.id; END'
+	),
+	'datasheet_search_delete': (
+		'AFTER DELETE ON datasheets BEGIN DELETE FROM datasheet_search WHERE rowid = old.id; END'
+	),
+	'datasheet_search_tag_link': (
+		'AFTER INSERT ON tag_links BEGIN '
+		'INSERT OR IGNORE INTO datasheet_search_stale (datasheet_id) VALUES (new.datasheet_id); END'
+	),
+	'datasheet_search_tag_unlink': (
+		'AFTER DELETE ON tag_links BEGIN '
+		'INSERT OR IGNORE INTO datasheet_search_stale (datasheet_id) VALUES (old.datasheet_id); END'
+	),
+	'datasheet_search_tag_rename': (
+		'AFTER UPDATE OF name ON datasheet_tags WHEN old.name IS NOT new.name BEGIN '
+		'INSERT OR IGNORE INTO datasheet_search_stale (datasheet_id) SELECT datasheet_id FROM tag_links WHERE tag_id = new.id; END'
+	),
+}
+
+def refresh_search_index(cur):
+	"""
+	Bring the tags in the search index up to date for the datasheets whose tags
+	changed since the last refresh. Anything that links or unlinks tags has to
+	call this in the same transaction, so readers never need to write.
+	"""
+	cur.execute(
+		f'UPDATE datasheet_search SET tags = {_SEARCH_TAGS.format("datasheet_search.rowid")} '
+		'WHERE rowid IN (SELECT datasheet_id FROM datasheet_search_stale)'
+	)
+	cur.execute('DELETE FROM datasheet_search_stale')
+
+class CreateDatasheetSearchTable(Migration):
+	def up(self):
+		# NOTE: Prefix indexes for the short prefixes so they don't have to scan the whole term list
+		self.db.statement(
+			'CREATE VIRTUAL TABLE datasheet_search USING fts5('
+			'title, tags, vendor, filename, prefix = \'2 3\', tokenize = \'unicode61\')'
+		)
+		self.db.statement('CREATE TABLE datasheet_search_stale (datasheet_id INTEGER NOT NULL PRIMARY KEY)')
+
+		for name, trigger in _SEARCH_TRIGGERS.items():
+			self.db.statement(f'CREATE TRIGGER {name} {trigger}')
+
+		# Index anything that is already in the cache
+		self.db.statement(
+			'INSERT INTO datasheet_search (rowid, title, tags, vendor, filename) '
+			f'SELECT d.id, d.title, {_SEARCH_TAGS.format("d.id")}, s.name, d.filename '
+			'FROM datasheets d INNER JOIN scrapers s ON s.id = d.scraper_id'
+		)
+
+	def update(self, from_version):
+		# Added in schema v8
+		if not self.schema.has_table('datasheet_search'):
+			self.up()
+
+	def down(self):
+		for name in _SEARCH_TRIGGERS:
+			self.db.statement(f'DROP TRIGGER IF EXISTS {name}')
+		self.schema.drop('datasheet_search_stale')
+		self.schema.drop('datasheet_search')
+
 
 _MIGRATIONS = (
 	CreateDatasheetTable,
@@ -149,8 +741,14 @@ _MIGRATIONS = (
 	CreateDatasheetTagTable,
 	CreateTagLinkTable,
 	CreateCacheMetadataTable,
+	CreateSourceDigestTable,
+	CreateZoteroSyncTable,
+	CreateDatasheetSearchTable,
 )
 
+def set_schema_version(version):
+	set_metadata('schema_version', version)
+
 def check_schema(dbm):
 	# If we don't have the cache metadata table, we absolutely need to run migrations
 	try:
@@ -203,6 +801,9 @@ def run_migrations(dbm):
 		else:
 			mi.up()
 
+	# A fresh database is always at the current schema version
+	set_schema_version(config.TRAWLER_SCHEMA_VERSION)
+
 def run_update(dbm, from_version):
 	dbm_repo = DatabaseMigrationRepository(dbm, 'migrations')
 	inf(f'Updating Trawler schema from v{from_version} to v{config.TRAWLER_SCHEMA_VERSION}')
@@ -2,88 +2,738 @@
 import sys
 import time
 import re
+import json
+import random
+import hashlib
+import threading
 
-from os import path
+from os import path, remove, replace, stat, utime, link, makedirs
+from shutil import move, copyfile
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+import requests.adapters
 from requests import utils
 
+from tqdm import tqdm
+
 from . import config
 from .common import *
+from .pipeline import Stage
 
 
 __all__ = (
-	'download_resource', 'get_content'
+	'download_resource', 'download_resources', 'plan_downloads',
+	'get_content', 'get_stream', 'post_json',
+	'get_session', 'close_sessions', 'link_file',
+	'set_rate_limits', 'classify_failure',
+	'needs_download', 'download_stage',
 )
 
+# Per-host connection slots, shared by all the download workers
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+def _host_slot(url, args):
+	host = urlparse(url).netloc
+	with _host_slots_lock:
+		if host not in _host_slots:
+			_host_slots[host] = threading.BoundedSemaphore(max(args.max_per_host, 1))
+		return _host_slots[host]
+
+class TokenBucket:
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = max(burst, 1)
+		self.tokens = self.burst
+		self.last = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+				self.last = now
+
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+
+				wait = (1 - self.tokens) / self.rate
+
+			time.sleep(wait)
+
+# Per-host request budgets, anything not listed gets one request every `args.delay` seconds
+_rate_limits = {}
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def set_rate_limits(adapter_limits, cli_limits):
+	with _buckets_lock:
+		_rate_limits.clear()
+		_buckets.clear()
+		for host, (rate, burst) in adapter_limits.items():
+			_rate_limits[host] = (rate, burst)
+
+		# The user always gets the last word
+		for host, rate, burst in cli_limits:
+			_rate_limits[host] = (rate, burst)
+
+def _throttle(url, args):
+	host = urlparse(url).netloc
+	with _buckets_lock:
+		if host not in _buckets:
+			if host in _rate_limits:
+				rate, burst = _rate_limits[host]
+			elif args.delay > 0:
+				rate, burst = (1 / args.delay, 1)
+			else:
+				rate, burst = (None, None)
+
+			_buckets[host] = TokenBucket(rate, burst) if rate is not None and rate > 0 else None
+		bucket = _buckets[host]
+
+	if bucket is not None:
+		bucket.acquire()
+
+# Pooled keep-alive sessions, one per host
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _new_session(args):
+	s = requests.Session()
+	s.headers['User-Agent'] = args.user_agent
+	if not args.keep_alive:
+		s.headers['Connection'] = 'close'
+
+	adapter = requests.adapters.HTTPAdapter(
+		pool_connections = 1,
+		pool_maxsize = max(args.pool_size, 1)
+	)
+	s.mount('http://', adapter)
+	s.mount('https://', adapter)
+
+	return s
+
+def get_session(url, args):
+	host = urlparse(url).netloc
+	with _sessions_lock:
+		if host not in _sessions:
+			_sessions[host] = _new_session(args)
+		return _sessions[host]
+
+def close_sessions():
+	with _sessions_lock:
+		for s in _sessions.values():
+			s.close()
+		_sessions.clear()
+
+def _get(url, args, **kwargs):
+	return get_session(url, args).get(
+		url,
+		allow_redirects = True,
+		timeout = args.timeout,
+		**kwargs
+	)
+
+def _retry_after(r):
+	value = r.headers.get('retry-after')
+	if value is None:
+		return None
+
+	try:
+		return max(float(value), 0)
+	except ValueError:
+		pass
+
+	try:
+		when = parsedate_to_datetime(value)
+		return max((when - datetime.now(timezone.utc)).total_seconds(), 0)
+	except (TypeError, ValueError):
+		return None
+
+def classify_failure(e):
+	"""
+	Sort a failed request into something we can act on, returns the reason we
+	record, whether it's ever worth trying again, and how long the server asked us to wait.
+	"""
+	if isinstance(e, requests.HTTPError) and e.response is not None:
+		status = e.response.status_code
+		reason = f'HTTP {status}'
+		if status == 429 or status == 503:
+			return (reason, False, _retry_after(e.response))
+		elif status >= 500 or status == 408:
+			return (reason, False, None)
+		else:
+			return (reason, True, None)
+	elif isinstance(e, requests.exceptions.ConnectTimeout):
+		return ('Connect timeout', False, None)
+	elif isinstance(e, requests.exceptions.ReadTimeout):
+		return ('Read timeout', False, None)
+	elif isinstance(e, requests.exceptions.ConnectionError):
+		return ('Connection error', False, None)
+	elif isinstance(e, (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema)):
+		return ('Invalid URL', True, None)
+	else:
+		return (f'{type(e).__name__}: {e}', False, None)
+
+def _backoff(attempt, retry_after, args):
+	# Exponential backoff with full jitter, unless the server told us how long to wait
+	if retry_after is not None:
+		delay = min(retry_after, config.MAX_BACKOFF)
+	else:
+		delay = random.uniform(0, min(args.backoff * (2 ** attempt), config.MAX_BACKOFF))
+
+	if delay > 0:
+		time.sleep(delay)
+
+def _check_status(r):
+	if r.status_code >= 400:
+		raise requests.HTTPError(f'{r.status_code} {r.reason} for {r.url}', response = r)
+
 def get_content(url, args):
-	try_count = 0
-	while try_count < args.retry:
+	for attempt in range(args.retry):
 		try:
-			if args.delay > 0:
-				time.sleep(args.delay)
-
-			with requests.get(
-				url,
-				allow_redirects = True,
-				timeout = args.timeout,
-				headers = {
-					'User-Agent': args.user_agent
-				}
-			) as r:
+			_throttle(url, args)
+
+			with _get(url, args) as r:
+				_check_status(r)
 				return r.content
 
 		except Exception as e:
-			if isinstance(e, KeyboardInterrupt):
-				sys.quit()
-			else:
-				try_count += 1
+			reason, permanent, retry_after = classify_failure(e)
+			if permanent or attempt + 1 >= args.retry:
+				twrn(f'  => Unable to fetch {url}: {reason}')
+				break
 
-	if try_count != 0:
-		return False
+			_backoff(attempt, retry_after, args)
 
-def download_resource(dl_dir, ds, args):
-	tlog(f'  => Downloading {ds.title} ({ds.id})')
-	try_count = 0
-	while try_count < args.retry:
+	return False
+
+def post_json(url, args, payload, headers = None):
+	"""
+	POST `payload` as JSON to `url` and hand back the decoded JSON response,
+	or None if it couldn't be fetched.
+	"""
+	for attempt in range(args.retry):
 		try:
-			if args.delay > 0:
-				time.sleep(args.delay)
-
-			with requests.get(
-				ds.url,
-				allow_redirects = True,
-				timeout = args.timeout,
-				headers = {
-					'User-Agent': args.user_agent
-				}
+			_throttle(url, args)
+
+			with get_session(url, args).post(
+				url, json = payload, headers = headers if headers is not None else {},
+				allow_redirects = True, timeout = args.timeout
 			) as r:
-				fname = ''
-				if 'content-disposition' in r.headers.keys():
-					fname = re.findall('filename=(.*)', r.headers['content-disposition'])[0]
-				else:
-					fname = ds.url.split('/')[-1]
-
-				ds.filename = fname
-				if not ds.dl_location.endswith(fname):
-					ds.dl_location = path.join(ds.dl_location, fname)
-				ds.save()
-				tlog(f'    ==> Saving {fname} to {ds.dl_location}')
-				with open(ds.dl_location, 'wb') as file:
-					file.write(r.content)
-
-				ds.downloaded = True
-				ds.save()
+				_check_status(r)
+				return r.json()
+
+		except Exception as e:
+			reason, permanent, retry_after = classify_failure(e)
+			if permanent or attempt + 1 >= args.retry:
+				twrn(f'  => Unable to fetch {url}: {reason}')
 				break
+
+			_backoff(attempt, retry_after, args)
+
+	return None
+
+def get_stream(url, args, headers = None):
+	"""
+	Like `get_content`, but hands back the response with the body still unread
+	so the caller can stream it, or None if it couldn't be fetched.
+	The caller is responsible for closing it.
+	"""
+	for attempt in range(args.retry):
+		r = None
+		try:
+			_throttle(url, args)
+
+			r = _get(url, args, stream = True, headers = headers if headers is not None else {})
+			_check_status(r)
+			r.raw.decode_content = True
+			return r
+
 		except Exception as e:
-			if isinstance(e, KeyboardInterrupt):
-				sys.quit()
-			else:
+			if r is not None:
+				r.close()
+
+			reason, permanent, retry_after = classify_failure(e)
+			if permanent or attempt + 1 >= args.retry:
+				twrn(f'  => Unable to fetch {url}: {reason}')
+				break
+
+			_backoff(attempt, retry_after, args)
+
+	return None
+
+def _part_state(dl_location):
+	# Returns how far a previous attempt got with this file, along with the
+	# validators it was fetched against, or None if there is nothing to resume
+	part_file = f'{dl_location}.part'
+	if not path.isfile(part_file) or not path.isfile(f'{part_file}.json'):
+		return None
+
+	try:
+		with open(f'{part_file}.json', 'r') as f:
+			state = json.load(f)
+	except (OSError, ValueError):
+		return None
+
+	# Weak ETags can't be used with If-Range, so we need something strong to check against
+	etag = state.get('etag')
+	if etag is not None and etag.startswith('W/'):
+		etag = None
+
+	if etag is None and state.get('last_modified') is None:
+		return None
+
+	state['etag'] = etag
+	state['offset'] = path.getsize(part_file)
+	return state
+
+def _discard_part(dl_location):
+	for f in (f'{dl_location}.part', f'{dl_location}.part.json'):
+		if path.exists(f):
+			remove(f)
+
+def _fetch_resource(job, args):
+	# NOTE: This runs on the download workers, it must not touch the database,
+	# everything it learns is handed back in the result for the writer to apply.
+	tlog(f'  => Downloading {job["title"]} ({job["id"]})')
+	result = {
+		'id': job['id'],
+		'filename': None,
+		'dl_location': job['dl_location'],
+		'downloaded': False,
+		'validators': None,
+		'sha256': None,
+		'error': None,
+		'error_permanent': False,
+	}
+
+	# Where the file ended up last time, if we know, so we can find any partial download
+	dl_location = None
+	if job['filename'] is not None and job['dl_location'].endswith(job['filename']):
+		dl_location = job['dl_location']
+
+	for attempt in range(args.retry):
+		headers = {
+			# We resume by byte offset, so we need the body exactly as it's stored
+			'Accept-Encoding': 'identity',
+		}
+
+		resume = _part_state(dl_location) if dl_location is not None else None
+		if resume is not None and resume['offset'] > 0:
+			headers['Range'] = f'bytes={resume["offset"]}-'
+			headers['If-Range'] = resume['etag'] if resume['etag'] is not None else resume['last_modified']
+		elif job['validators'] is not None:
+			# If we already have a copy on disk, ask the server to only send it if it changed
+			if job['validators']['etag'] is not None:
+				headers['If-None-Match'] = job['validators']['etag']
+			if job['validators']['last_modified'] is not None:
+				headers['If-Modified-Since'] = job['validators']['last_modified']
+
+		try:
+			with _host_slot(job['url'], args):
+				_throttle(job['url'], args)
+
+				with _get(job['url'], args, stream = True, headers = headers) as r:
+					if r.status_code == 304:
+						tlog(f'    ==> {job["title"]} is unchanged, skipping')
+						# Bump the mtime so the planner knows when we last checked it
+						utime(job['dl_location'])
+						result['downloaded'] = True
+						break
+
+					if r.status_code == 416:
+						# Whatever we had on disk doesn't line up with the remote file anymore
+						_discard_part(dl_location)
+						raise IOError('Requested range not satisfiable, restarting from the beginning')
+
+					_check_status(r)
+
+					fname = ''
+					if 'content-disposition' in r.headers.keys():
+						fname = re.findall('filename=(.*)', r.headers['content-disposition'])[0]
+					else:
+						fname = job['url'].split('/')[-1]
+
+					dl_location = job['dl_location']
+					if not dl_location.endswith(fname):
+						dl_location = path.join(dl_location, fname)
+
+					result['filename'] = fname
+					result['dl_location'] = dl_location
+
+					if r.status_code == 206:
+						tlog(f'    ==> Resuming {fname} at byte {resume["offset"]} to {dl_location}')
+					else:
+						tlog(f'    ==> Saving {fname} to {dl_location}')
+					total, digest = _stream_to_file(r, dl_location, args)
+
+					result['downloaded'] = True
+					result['sha256'] = digest
+					result['validators'] = {
+						'etag': r.headers.get('etag'),
+						'last_modified': r.headers.get('last-modified'),
+						'content_length': total,
+					}
+					break
+		except Exception as e:
+			reason, permanent, retry_after = classify_failure(e)
+			result['error'] = reason
+			result['error_permanent'] = permanent
+
+			if permanent:
+				break
+			elif attempt + 1 < args.retry:
 				twrn(f'  => Download failed {e}, retrying')
-				try_count += 1
+				# NOTE: We back off outside of the host slot so others can use it in the mean time
+				_backoff(attempt, retry_after, args)
+
+	if not result['downloaded']:
+		terr(f'  => Unable to download datasheet with id {job["id"]}: {result["error"]}')
+
+	return result
+
+def _expected_length(r):
+	# If the body is content-encoded then what we write out won't match the
+	# length on the wire, so there is nothing for us to check it against.
+	if r.headers.get('content-encoding', 'identity') != 'identity':
+		return None
+
+	try:
+		return int(r.headers['content-length'])
+	except (KeyError, ValueError):
+		return None
+
+def _content_range(r):
+	# Parse out the `bytes start-end/total` of a partial response
+	m = re.match(r'bytes\s+(\d+)-(\d+)/(\d+|\*)', r.headers.get('content-range', ''))
+	if m is None:
+		raise IOError(f'Bad Content-Range in partial response: {r.headers.get("content-range")}')
+
+	return (int(m.group(1)), None if m.group(3) == '*' else int(m.group(3)))
+
+def _stream_to_file(r, dl_location, args):
+	part_file = f'{dl_location}.part'
+
+	if r.status_code == 206:
+		offset, expected = _content_range(r)
+		if not path.isfile(part_file) or offset != path.getsize(part_file):
+			_discard_part(dl_location)
+			raise IOError(f'Partial response starts at byte {offset} which we don\'t have')
+		mode = 'ab'
+	else:
+		# Either a fresh download or the server ignored our range, start over
+		offset, expected = 0, _expected_length(r)
+		with open(f'{part_file}.json', 'w') as f:
+			json.dump({
+				'url': r.url,
+				'etag': r.headers.get('etag'),
+				'last_modified': r.headers.get('last-modified'),
+			}, f)
+		mode = 'wb'
+
+	digest = hashlib.sha256()
+	if offset > 0:
+		# Catch the hash up with what we already have before appending to it
+		with open(part_file, 'rb') as file:
+			for chunk in iter(lambda: file.read(config.DOWNLOAD_CHUNK_SIZE), b''):
+				digest.update(chunk)
+
+	written = offset
+	# NOTE: The part file is deliberately left behind if this fails so the next attempt can resume it
+	with open(part_file, mode) as file:
+		for chunk in r.iter_content(chunk_size = config.DOWNLOAD_CHUNK_SIZE):
+			file.write(chunk)
+			digest.update(chunk)
+			written += len(chunk)
+
+	if expected is not None and written != expected:
+		if written > expected:
+			_discard_part(dl_location)
+		raise IOError(f'Short read, got {written} of {expected} bytes')
+
+	digest = digest.hexdigest()
+	if args.blob_store is not None:
+		blob = _blob_path(args.blob_store, digest)
+		if path.exists(blob):
+			remove(part_file)
+		else:
+			makedirs(path.dirname(blob), exist_ok = True)
+			move(part_file, blob)
+		link_file(blob, dl_location)
+	else:
+		replace(part_file, dl_location)
+	remove(f'{part_file}.json')
+
+	return (written, digest)
+
+def _blob_path(store, digest):
+	return path.join(store, digest[:2], digest)
+
+def _reflink(src, dst):
+	import fcntl
+	FICLONE = 0x40049409
+
+	with open(src, 'rb') as s, open(dst, 'wb') as d:
+		fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+def link_file(src, dst):
+	"""
+	Put a copy of `src` at `dst`, sharing the underlying storage if we can.
+	Tries a hardlink, then a reflink, and falls back to a full copy.
+	"""
+	tmp = f'{dst}.link'
+	if path.exists(tmp):
+		remove(tmp)
+
+	try:
+		link(src, tmp)
+	except OSError:
+		try:
+			_reflink(src, tmp)
+		except (OSError, ImportError):
+			copyfile(src, tmp)
+
+	replace(tmp, dst)
+
+def _plan_one(ds, args, now, refresh_age):
+	# Sort a datasheet into what we'd do with it, or None if there is nothing to fetch
+	if ds.url is None:
+		return None
+
+	# Don't keep hammering links we already know are dead
+	if ds.dl_error_permanent and not (args.force or args.retry_failed):
+		return 'dead'
+
+	on_disk = (
+		ds.downloaded and ds.dl_location is not None and
+		ds.filename is not None and path.isfile(ds.dl_location)
+	)
+
+	if on_disk and not args.force:
+		st = stat(ds.dl_location)
+		complete = ds.content_length is None or st.st_size == ds.content_length
+		fresh = refresh_age is None or (now - st.st_mtime) < refresh_age
+		if complete and fresh:
+			return 'up_to_date'
+
+	return 'stale' if on_disk else 'new'
+
+def _refresh_age(args):
+	return args.refresh_older_than * 86400 if args.refresh_older_than is not None else None
+
+def needs_download(ds, args):
+	"""
+	Whether the datasheet needs fetching, the same as `plan_downloads` but for
+	one datasheet at a time.
+	"""
+	return _plan_one(ds, args, time.time(), _refresh_age(args)) in ('new', 'stale')
+
+def plan_downloads(sheets, args):
+	"""
+	Work out which of the given datasheets actually need fetching, based on
+	what we already have on disk and the `--force` / `--refresh-older-than` policy.
+	"""
+	now = time.time()
+	refresh_age = _refresh_age(args)
+
+	pending = []
+	counts = { 'new': 0, 'stale': 0, 'up_to_date': 0, 'dead': 0, None: 0 }
+	est_bytes = 0
+	unknown_size = 0
+
+	for ds in sheets:
+		plan = _plan_one(ds, args, now, refresh_age)
+		counts[plan] += 1
+		if plan not in ('new', 'stale'):
+			continue
+
+		if ds.content_length is not None:
+			est_bytes += ds.content_length
+		else:
+			unknown_size += 1
+
+		pending.append(ds)
+
+	inf(f'Download plan: {len(pending)} to fetch ({counts["new"]} new, {counts["stale"]} to refresh), {counts["up_to_date"]} up to date')
+	if counts['dead'] > 0:
+		inf(f'  => Skipping {counts["dead"]} dead links, use --retry-failed to try them again')
+	if len(pending) > 0:
+		inf(f'  => Estimated {fmt_size(est_bytes)}' + (f', plus {unknown_size} of unknown size' if unknown_size > 0 else ''))
+
+	return pending
+
+def _make_job(dl_dir, ds, args):
+	validators = None
+	if not args.force and ds.downloaded and ds.dl_location is not None and path.isfile(ds.dl_location):
+		if ds.etag is not None or ds.last_modified is not None:
+			validators = {
+				'etag': ds.etag,
+				'last_modified': ds.last_modified,
+			}
+
+	return {
+		'id': ds.id,
+		'title': ds.title,
+		'url': ds.url,
+		'filename': ds.filename,
+		'dl_location': ds.dl_location if ds.dl_location is not None else dl_dir,
+		'validators': validators,
+	}
+
+def _apply_result(ds, result):
+	# A failed download only keeps where it was going if it left a partial file to resume from
+	if result['filename'] is not None and (result['downloaded'] or path.isfile(f'{result["dl_location"]}.part')):
+		ds.filename = result['filename']
+		ds.dl_location = result['dl_location']
+
+	if result['downloaded']:
+		ds.downloaded = True
+		ds.dl_error = None
+		ds.dl_error_permanent = False
+	elif result['error'] is not None:
+		ds.dl_error = result['error']
+		ds.dl_error_permanent = result['error_permanent']
+
+	if result['validators'] is not None:
+		ds.etag = result['validators']['etag']
+		ds.last_modified = result['validators']['last_modified']
+		ds.content_length = result['validators']['content_length']
+
+	if result['sha256'] is not None:
+		ds.sha256 = result['sha256']
+
+	if ds.is_dirty():
+		ds.save()
+
+	return result['downloaded']
+
+def _share_result(dl_dir, ds, result, args):
+	job = _make_job(dl_dir, ds, args)
+	shared = dict(result, id = job['id'], dl_location = job['dl_location'])
+
+	if not result['downloaded']:
+		return dict(shared, filename = None)
+
+	filename = result['filename']
+	if filename is None:
+		# A 304, so the file we already have for the datasheet that was fetched is still current
+		if ds.downloaded and ds.dl_location is not None and path.isfile(ds.dl_location):
+			return dict(shared, filename = None)
+
+		if not path.isfile(result['dl_location']):
+			# Nothing on disk to hand out, leave it to be fetched on the next run
+			return dict(shared, filename = None, downloaded = False)
+		filename = path.basename(result['dl_location'])
+		shared['filename'] = filename
+
+	dl_location = job['dl_location']
+	if not dl_location.endswith(filename):
+		dl_location = path.join(dl_location, filename)
+	shared['dl_location'] = dl_location
+
+	if dl_location != result['dl_location']:
+		try:
+			link_file(result['dl_location'], dl_location)
+		except OSError as e:
+			terr(f'  => Unable to share {result["dl_location"]} with datasheet {job["id"]}: {e}')
+			shared['downloaded'] = False
+
+	return shared
+
+def download_resource(dl_dir, ds, args):
+	return _apply_result(ds, _fetch_resource(_make_job(dl_dir, ds, args), args))
+
+def download_resources(dl_dir, sheets, args):
+	"""
+	Download all of the given datasheets using a pool of `args.jobs` workers,
+	with at most `args.max_per_host` of them talking to any one host at a time.
+
+	The workers only do the network and file I/O, all of the database updates
+	are applied from the calling thread as the downloads complete.
+	"""
+	downloaded = 0
+	with tqdm(
+			miniters = 1, total = len(sheets),
+		) as bar:
+			with ThreadPoolExecutor(max_workers = max(args.jobs, 1)) as pool:
+				# Only fetch each URL once, anything else wanting it gets a link to the same file
+				pending = {}
+				duplicates = {}
+				for ds in sheets:
+					if ds.url in duplicates:
+						duplicates[ds.url].append(ds)
+					else:
+						duplicates[ds.url] = []
+						pending[pool.submit(_fetch_resource, _make_job(dl_dir, ds, args), args)] = ds
+
+				try:
+					for fut in as_completed(pending):
+						ds = pending[fut]
+						result = fut.result()
+						bar.set_description(fixup_title(ds.title))
+						if _apply_result(ds, result):
+							downloaded += 1
+						bar.update(1)
+
+						for dup in duplicates[ds.url]:
+							bar.set_description(fixup_title(dup.title))
+							if _apply_result(dup, _share_result(dl_dir, dup, result, args)):
+								downloaded += 1
+							bar.update(1)
+				except KeyboardInterrupt:
+					# NOTE: shutdown() only grew cancel_futures in 3.9, so drop what hasn't started by hand
+					for fut in pending:
+						fut.cancel()
+					raise
+
+	return downloaded
+
+def download_stage(dl_dir, args):
+	"""
+	A pipeline stage that downloads the datasheets handed to it, anything that
+	doesn't need fetching is passed over. As with `download_resources` only the
+	network and file I/O happen on the workers.
+	"""
+	pool = ThreadPoolExecutor(max_workers = max(args.jobs, 1))
+	seen = set()
+	# URL to the datasheets waiting on it being fetched
+	in_flight = {}
+
+	def start(ds, done):
+		if ds.id in seen or not needs_download(ds, args):
+			done(None, None)
+			return
+
+		seen.add(ds.id)
+		if ds.url in in_flight:
+			in_flight[ds.url].append(ds)
+			done(None, None)
+			return
+
+		in_flight[ds.url] = []
+		pool.submit(_fetch_resource, _make_job(dl_dir, ds, args), args).add_done_callback(
+			lambda fut: done(fut.result(), None) if fut.exception() is None else done(None, fut.exception())
+		)
+
+	def handle(ds, result, error):
+		if error is not None:
+			terr(f'  => Unable to download datasheet {ds.id}: {error}')
+			in_flight.pop(ds.url, None)
+		if result is None:
+			# Either it failed, it was passed over, or it's waiting on another datasheet with the same URL
+			return None
+
+		_apply_result(ds, result)
+		for dup in in_flight.pop(ds.url, []):
+			_apply_result(dup, _share_result(dl_dir, dup, result, args))
 
-	if try_count != 0:
-		terr(f'  => Unable to download datasheet with id {ds.id}')
-		return False
+		return None
 
-	return True
+	return Stage('download', start, handle, capacity = max(args.jobs, 1), close = lambda: pool.shutdown(wait = True))
@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: BSD-3-Clause
+from queue import Queue
+from collections import deque
+
+from tqdm import tqdm
+
+from . import config
+from .common import *
+
+__all__ = (
+	'Stage', 'Pipeline',
+)
+
+class Stage:
+	"""
+	One step of a `Pipeline`.
+
+	`start(item, done)` kicks off the work for an item, wherever it likes, and
+	arranges for `done(result, error)` to be called from any thread once it's
+	finished. `handle(item, result, error)` is then called back on the
+	pipeline's thread, so it's safe to touch the database, and returns the
+	items to pass on to the next stage, if any. At most `capacity` items are
+	worked on at once. Once it's part of a pipeline, `pipeline` is set so the
+	stage can feed more work back into itself.
+	"""
+
+	def __init__(self, name, start, handle, capacity = 1, close = None):
+		self.name = name
+		self.start = start
+		self.handle = handle
+		self.capacity = max(capacity, 1)
+		self.close = close
+		self.pipeline = None
+
+class Pipeline:
+	"""
+	Runs items through a series of stages, with each item moving on to the next
+	stage as soon as it's ready. A stage won't take on more work while the
+	queue in front of the next one is full, so how much is held in memory is
+	bounded by `queue_size`.
+	"""
+
+	def __init__(self, stages, queue_size = config.DEFAULT_PIPELINE_QUEUE):
+		self.stages = list(stages)
+		self.queue_size = max(queue_size, 1)
+
+		self._pending = [ deque() for _ in self.stages ]
+		self._seeds = [ deque() for _ in self.stages ]
+		self._in_flight = [ 0 for _ in self.stages ]
+		self._events = Queue()
+		self._bars = []
+
+		for stage in self.stages:
+			stage.pipeline = self
+
+	def _index(self, stage):
+		for i, s in enumerate(self.stages):
+			if s is stage or s.name == stage:
+				return i
+		raise KeyError(stage)
+
+	def feed(self, stage, items):
+		"""
+		Queue up `items` for `stage`, either the stage or its name. They're only
+		pulled in as there is room for them.
+		"""
+		self._seeds[self._index(stage)].append(iter(items))
+
+	def _next_item(self, i):
+		if len(self._pending[i]) > 0:
+			return (True, self._pending[i].popleft())
+
+		while len(self._seeds[i]) > 0:
+			try:
+				return (True, next(self._seeds[i][0]))
+			except StopIteration:
+				self._seeds[i].popleft()
+
+		return (False, None)
+
+	def _has_room(self, i):
+		# The last stage has nowhere to send things, so it's never held up
+		return i + 1 >= len(self.stages) or len(self._pending[i + 1]) < self.queue_size
+
+	def _start_work(self):
+		# Work from the back so things already in the pipeline drain before new work comes in
+		for i in reversed(range(len(self.stages))):
+			stage = self.stages[i]
+			while self._in_flight[i] < stage.capacity and self._has_room(i):
+				more, item = self._next_item(i)
+				if not more:
+					break
+
+				self._in_flight[i] += 1
+				stage.start(item, lambda result, error, i = i, item = item: self._events.put((i, item, result, error)))
+
+	def _idle(self):
+		return all(map(lambda n: n == 0, self._in_flight)) and all(map(lambda p: len(p) == 0, self._pending)) and all(map(lambda s: len(s) == 0, self._seeds))
+
+	def run(self):
+		"""
+		Run until every stage has run dry.
+		"""
+		self._bars = [ tqdm(desc = stage.name, position = i, miniters = 1) for i, stage in enumerate(self.stages) ]
+		try:
+			while True:
+				self._start_work()
+				if self._idle():
+					break
+
+				i, item, result, error = self._events.get()
+				self._in_flight[i] -= 1
+				self._bars[i].update(1)
+
+				out = self.stages[i].handle(item, result, error)
+				if out is not None and i + 1 < len(self.stages):
+					self._pending[i + 1].extend(out)
+		finally:
+			for bar in self._bars:
+				bar.close()
+			for stage in self.stages:
+				if stage.close is not None:
+					stage.close()